@@ -0,0 +1,519 @@
+"""
+In process stand in for the Google Drive REST API used by the benchmarks.
+
+The real googleapiclient service is built with an http object which answers requests from memory, so GoogleDrive
+and the batch, media upload and download code of googleapiclient run unchanged and every request they send is
+counted. The resumable upload and ranged download sessions of StreamUpload and DriveDownloadStream are answered by
+the same server. Latency, bandwidth and a rate limit can be injected.
+"""
+import datetime
+import email.parser
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter
+
+import httplib2
+from googleapiclient import discovery
+from requests.structures import CaseInsensitiveDict
+
+try:
+    from googleapiclient.discovery_cache import get_static_doc
+except ImportError:
+    get_static_doc = None
+
+folder_type = 'application/vnd.google-apps.folder'
+api_root = 'https://www.googleapis.com'
+session_prefix = api_root + '/upload/drive/v3/sessions/'
+rate_limit_error = {'error': {'code': 403, 'message': 'User Rate Limit Exceeded',
+                              'errors': [{'reason': 'userRateLimitExceeded', 'domain': 'usageLimits'}]}}
+
+
+class QueryError(Exception):
+    pass
+
+
+class Query:
+    """ Parses the subset of the Drive query language used by the package into a predicate on file metadata """
+
+    token_re = re.compile(r"\s*(?:(?P<string>'(?:\\.|[^'\\])*')|(?P<op>!=|<=|>=|=|<|>|\(|\)|\{|\})|"
+                          r"(?P<word>[A-Za-z_]+))")
+    operators = {'=': lambda a, b: a == b, '!=': lambda a, b: a != b, '<': lambda a, b: a < b,
+                 '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '>=': lambda a, b: a >= b}
+
+    def __init__(self, q):
+        self.tokens = self.tokenize(q or '')
+        self.position = 0
+        self.predicate = self.parse_or() if self.tokens else (lambda f: True)
+        if self.position != len(self.tokens):
+            raise QueryError(f'Unexpected {self.tokens[self.position]} in {q}')
+
+    def tokenize(self, q):
+        tokens = []
+        position = 0
+        q = q.rstrip()
+        while position < len(q):
+            match = self.token_re.match(q, position)
+            if not match or match.end() == position:
+                raise QueryError(f'Cannot parse {q[position:]}')
+            position = match.end()
+            if match.group('string') is not None:
+                tokens.append(('string', match.group('string')[1:-1].replace("\\'", "'")))
+            elif match.group('op') is not None:
+                tokens.append(('op', match.group('op')))
+            else:
+                tokens.append(('word', match.group('word')))
+        return tokens
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if (kind and token[0] != kind) or (value and token[1] != value):
+            raise QueryError(f'Expected {value or kind} not {token[1]}')
+        self.position += 1
+        return token[1]
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek() == ('word', 'or'):
+            self.take()
+            terms.append(self.parse_and())
+        return terms[0] if len(terms) == 1 else (lambda f: any(t(f) for t in terms))
+
+    def parse_and(self):
+        terms = [self.parse_term()]
+        while self.peek() == ('word', 'and'):
+            self.take()
+            terms.append(self.parse_term())
+        return terms[0] if len(terms) == 1 else (lambda f: all(t(f) for t in terms))
+
+    def parse_term(self):
+        kind, value = self.peek()
+        if (kind, value) == ('word', 'not'):
+            self.take()
+            term = self.parse_term()
+            return lambda f: not term(f)
+        if (kind, value) == ('op', '('):
+            self.take()
+            term = self.parse_or()
+            self.take('op', ')')
+            return term
+        if kind == 'string':
+            parent = self.take()
+            self.take('word', 'in')
+            self.take('word', 'parents')
+            return lambda f: parent in f.get('parents', [])
+        field = self.take('word')
+        if field == 'sharedWithMe':
+            return lambda f: f.get('_shared', False)
+        if field == 'appProperties':
+            self.take('word', 'has')
+            self.take('op', '{')
+            self.take('word', 'key')
+            self.take('op', '=')
+            key = self.take('string')
+            self.take('word', 'and')
+            self.take('word', 'value')
+            self.take('op', '=')
+            value = self.take('string')
+            self.take('op', '}')
+            return lambda f: f.get('appProperties', {}).get(key) == value
+        if self.peek() == ('word', 'contains'):
+            self.take()
+            text = self.take('string')
+            return lambda f: text in str(f.get(field, ''))
+        operator = self.operators[self.take('op')]
+        kind, value = self.peek()
+        self.take()
+        if kind == 'word':
+            value = value == 'true'
+            return lambda f: operator(bool(f.get(field, False)), value)
+        return lambda f: operator(f.get(field), value)
+
+    def __call__(self, f):
+        return self.predicate(f)
+
+
+class Response:
+    def __init__(self, status, body=b'', headers=None):
+        self.status = status
+        self.headers = CaseInsensitiveDict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+            self.headers.setdefault('Content-Type', 'application/json')
+        self.body = body
+
+
+class FakeDriveServer:
+    """
+    Files held in memory and shared by every client of the server. Each request sleeps for latency seconds plus the
+    time to transfer its body at bandwidth bytes per second, and is refused with a userRateLimitExceeded error once
+    more than rate_limit requests a second have been made.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, rate_limit=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.files = {}
+        self.contents = {}
+        self.sessions = {}
+        self.ids = itertools.count(1000)
+        self.calls = Counter()
+        self.tokens = rate_limit or 0
+        self.token_time = time.time()
+        self.document = json.loads(get_static_doc('drive', 'v3')) if get_static_doc else None
+
+    # Setup helpers
+
+    def now(self):
+        return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+    def add_file(self, name, parents, mime_type='application/octet-stream', content=None, **metadata):
+        """ Adds a file without a request, metadata such as createdTime overrides the defaults """
+        with self.lock:
+            file_id = f'f{next(self.ids)}'
+            created = self.now()
+            f = dict(id=file_id, name=name, mimeType=mime_type, parents=list(parents), trashed=False,
+                     createdTime=created, modifiedTime=created, webViewLink=f'https://drive.example/{file_id}')
+            f.update(metadata)
+            if mime_type != folder_type:
+                content = content or b''
+                f.update(size=str(len(content)), md5Checksum=hashlib.md5(content).hexdigest())
+                self.contents[file_id] = content
+            self.files[file_id] = f
+            return dict(f)
+
+    def add_folder_path(self, path, shared=True):
+        """ Folders of path with the top folder shared with the service account as the package expects """
+        parent = None
+        for name in path.split('/'):
+            existing = [f for f in self.files.values() if f['name'] == name and f['mimeType'] == folder_type and
+                        (f['parents'] == [parent] if parent else f.get('_shared'))]
+            if existing:
+                parent = existing[0]['id']
+            else:
+                parent = self.add_file(name, [parent] if parent else [], folder_type,
+                                       **({} if parent else {'_shared': shared}))['id']
+        return self.files[parent]
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    # Clients
+
+    def http(self):
+        return FakeHttp(self)
+
+    def session(self, *_args, **_kwargs):
+        return FakeSession(self)
+
+    def service(self):
+        if self.document is None:
+            raise RuntimeError('googleapiclient with bundled discovery documents is needed')
+        return discovery.build_from_document(self.document, http=self.http())
+
+    # Request handling
+
+    def throttle(self, size=0):
+        delay = self.latency + (size / self.bandwidth if self.bandwidth else 0)
+        if delay:
+            time.sleep(delay)
+        if not self.rate_limit:
+            return True
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate_limit, self.tokens + (now - self.token_time) * self.rate_limit)
+            self.token_time = now
+            if self.tokens < 1:
+                self.calls['rate_limited'] += 1
+                return False
+            self.tokens -= 1
+            return True
+
+    def request(self, method, url, headers=None, body=b''):
+        headers = CaseInsensitiveDict(headers or {})
+        body = body.encode() if isinstance(body, str) else (body or b'')
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        with self.lock:
+            self.calls['requests'] += 1
+        if path == '/batch/drive/v3':
+            return self.batch(headers, body)
+        if not self.throttle(len(body)):
+            return Response(403 if not url.startswith(session_prefix) else 429, rate_limit_error)
+        if url.startswith(session_prefix):
+            return self.upload_chunk(url[len(session_prefix):], headers, body)
+        response = self.route(method, path, params, headers, body)
+        if self.bandwidth and len(response.body) > 1024:
+            # Downloads take the time of their response body
+            time.sleep(len(response.body) / self.bandwidth)
+        return response
+
+    def route(self, method, path, params, headers, body):
+        match = re.match(r'^/(upload/)?drive/v3/(files|about)(?:/([^/]+))?(?:/(copy))?$', path)
+        if not match:
+            return Response(404, {'error': {'code': 404, 'message': f'Unknown path {path}'}})
+        upload, collection, file_id, copy = match.groups()
+        data = json.loads(body) if body and headers.get('Content-Type', '').startswith('application/json') else {}
+        if collection == 'about':
+            return self.call('about.get', lambda: self.about())
+        if upload:
+            return self.call('upload.start', lambda: self.start_upload(params, data))
+        if file_id == 'trash' and method == 'DELETE':
+            return self.call('files.emptyTrash', self.empty_trash)
+        if file_id is None and method == 'GET':
+            return self.call('files.list', lambda: self.list(params))
+        if file_id is None and method == 'POST':
+            return self.call('files.create', lambda: self.missing_parent(data) or Response(200, self.create(data, b'')))
+        if copy:
+            return self.call('files.copy', lambda: self.copy(file_id, data))
+        if method == 'GET' and params.get('alt') == 'media':
+            return self.call('files.media', lambda: self.media(file_id, headers))
+        if method == 'GET':
+            return self.call('files.get', lambda: self.get(file_id))
+        if method == 'PATCH':
+            return self.call('files.update', lambda: self.update(file_id, data))
+        if method == 'DELETE':
+            return self.call('files.delete', lambda: self.delete(file_id))
+        return Response(405, {'error': {'code': 405, 'message': f'{method} {path}'}})
+
+    def call(self, name, function):
+        with self.lock:
+            self.calls[name] += 1
+            return function()
+
+    def not_found(self, file_id):
+        return Response(404, {'error': {'code': 404, 'message': f'File not found: {file_id}'}})
+
+    @staticmethod
+    def public(f):
+        return {k: v for k, v in f.items() if not k.startswith('_')}
+
+    def about(self):
+        usage = sum(len(c) for c in self.contents.values())
+        return Response(200, {'storageQuota': {'limit': str(15 * 1024 ** 3), 'usage': str(usage)}})
+
+    def list(self, params):
+        try:
+            query = Query(params.get('q'))
+        except QueryError as e:
+            return Response(400, {'error': {'code': 400, 'message': str(e)}})
+        files = [f for f in self.files.values() if query(f)]
+        order = params.get('orderBy', '')
+        if order.startswith('createdTime'):
+            files.sort(key=lambda f: f['createdTime'], reverse=order.endswith('desc'))
+        start = int(params.get('pageToken') or 0)
+        page_size = min(int(params.get('pageSize', 100)), 1000)
+        result = {'files': [self.public(f) for f in files[start:start + page_size]]}
+        if start + page_size < len(files):
+            result['nextPageToken'] = str(start + page_size)
+        return Response(200, result)
+
+    def create(self, data, content, mime_type=None):
+        file_id = f'f{next(self.ids)}'
+        created = self.now()
+        f = dict(data, id=file_id, trashed=False, createdTime=created, modifiedTime=created,
+                 webViewLink=f'https://drive.example/{file_id}')
+        f.setdefault('mimeType', mime_type or 'application/octet-stream')
+        f.setdefault('parents', [])
+        if f['mimeType'] != folder_type:
+            f.update(size=str(len(content)), md5Checksum=hashlib.md5(content).hexdigest())
+            self.contents[file_id] = bytes(content)
+        self.files[file_id] = f
+        return self.public(f)
+
+    def missing_parent(self, data):
+        for parent in data.get('parents', []):
+            if parent not in self.files:
+                return self.not_found(parent)
+
+    def get(self, file_id):
+        if file_id not in self.files:
+            return self.not_found(file_id)
+        return Response(200, self.public(self.files[file_id]))
+
+    def update(self, file_id, data):
+        if file_id not in self.files:
+            return self.not_found(file_id)
+        f = self.files[file_id]
+        if 'appProperties' in data:
+            f['appProperties'] = dict(f.get('appProperties', {}), **data.pop('appProperties'))
+        f.update(data, modifiedTime=self.now())
+        return Response(200, self.public(f))
+
+    def copy(self, file_id, data):
+        if file_id not in self.files:
+            return self.not_found(file_id)
+        source = {k: v for k, v in self.files[file_id].items() if k not in ('size', 'md5Checksum', 'id')}
+        return Response(200, self.create(dict(source, **data), self.contents.get(file_id, b'')))
+
+    def delete(self, file_id):
+        if self.files.pop(file_id, None) is None:
+            return self.not_found(file_id)
+        self.contents.pop(file_id, None)
+        return Response(204)
+
+    def empty_trash(self):
+        for file_id in [k for k, f in self.files.items() if f.get('trashed')]:
+            self.files.pop(file_id)
+            self.contents.pop(file_id, None)
+        return Response(204)
+
+    def media(self, file_id, headers):
+        if file_id not in self.contents:
+            return self.not_found(file_id)
+        content = self.contents[file_id]
+        byte_range = re.match(r'bytes=(\d+)-(\d*)', headers.get('Range', ''))
+        if not byte_range:
+            return Response(200, content, {'Content-Type': 'application/octet-stream'})
+        start = int(byte_range.group(1))
+        end = min(int(byte_range.group(2)) if byte_range.group(2) else len(content) - 1, len(content) - 1)
+        return Response(206, content[start:end + 1], {'Content-Type': 'application/octet-stream',
+                                                      'Content-Range': f'bytes {start}-{end}/{len(content)}'})
+
+    # Resumable uploads
+
+    def start_upload(self, params, data):
+        if params.get('uploadType') != 'resumable':
+            return Response(400, {'error': {'code': 400, 'message': 'Only resumable uploads are supported'}})
+        missing = self.missing_parent(data)
+        if missing:
+            return missing
+        session_id = str(next(self.ids))
+        self.sessions[session_id] = {'metadata': data, 'data': bytearray()}
+        return Response(200, b'', {'Location': session_prefix + session_id})
+
+    def upload_chunk(self, session_id, headers, body):
+        with self.lock:
+            self.calls['upload.chunk'] += 1
+            session = self.sessions.get(session_id)
+            if session is None:
+                return Response(404, {'error': {'code': 404, 'message': 'Upload session not found'}})
+            content_range = re.match(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)', headers.get('Content-Range', ''))
+            if content_range and content_range.group(1) is not None:
+                start = int(content_range.group(1))
+                if start == len(session['data']):
+                    session['data'] += body
+                elif start > len(session['data']):
+                    return Response(400, {'error': {'code': 400, 'message': 'Chunk beyond the stored data'}})
+                else:
+                    # Resent data overlapping what is already stored
+                    session['data'][start:] = body
+            total = content_range.group(3) if content_range else '*'
+            if total != '*' and len(session['data']) == int(total):
+                del self.sessions[session_id]
+                return Response(200, self.create(session['metadata'], session['data']))
+            range_headers = {'Range': f'bytes=0-{len(session["data"]) - 1}'} if session['data'] else {}
+            return Response(308, b'', range_headers)
+
+    # Batches
+
+    def batch(self, headers, body):
+        with self.lock:
+            self.calls['batch'] += 1
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        boundary = 'batch_' + hashlib.md5(body).hexdigest()
+        parts = []
+        for part in message.get_payload():
+            content_id = part['Content-ID'].strip('<>')
+            payload = part.get_payload(decode=True) or part.get_payload().encode()
+            head, _, request_body = payload.replace(b'\r\n', b'\n').partition(b'\n\n')
+            lines = head.decode().split('\n')
+            method, target, _version = lines[0].split(' ')
+            request_headers = dict(line.split(': ', 1) for line in lines[1:] if ': ' in line)
+            if self.throttle():
+                parsed = urllib.parse.urlsplit(target)
+                response = self.route(method, parsed.path, dict(urllib.parse.parse_qsl(parsed.query)),
+                                      CaseInsensitiveDict(request_headers), request_body.strip())
+            else:
+                response = Response(403, rate_limit_error)
+            parts.append(f'--{boundary}\r\nContent-Type: application/http\r\n'
+                         f'Content-ID: <response-{content_id}>\r\n\r\n'
+                         f'HTTP/1.1 {response.status} OK\r\nContent-Type: application/json\r\n\r\n'.encode()
+                         + response.body + b'\r\n')
+        return Response(200, b''.join(parts) + f'--{boundary}--\r\n'.encode(),
+                        {'Content-Type': f'multipart/mixed; boundary={boundary}'})
+
+
+class FakeHttp:
+    """ httplib2.Http compatible object passing the requests of googleapiclient to the server """
+
+    def __init__(self, server):
+        self.server = server
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        if hasattr(body, 'read'):
+            body = body.read()
+        response = self.server.request(method, uri, headers, body)
+        info = dict(response.headers, status=str(response.status))
+        return httplib2.Response(info), response.body
+
+
+class FakeSessionResponse:
+    """ The parts of requests.Response read by StreamUpload and get_media """
+
+    def __init__(self, response):
+        self.status_code = response.status
+        self.headers = response.headers
+        self.content = response.body
+
+    @property
+    def text(self):
+        return self.content.decode(errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class FakeSession:
+    """ AuthorizedSession stand in for the resumable uploads and ranged downloads """
+
+    def __init__(self, server):
+        self.server = server
+
+    def request(self, method, url, params=None, data=None, json=None, headers=None, **_kwargs):
+        if params:
+            url += ('&' if '?' in url else '?') + urllib.parse.urlencode(params)
+        headers = dict(headers or {})
+        if json is not None:
+            data = globals()['json'].dumps(json)
+            headers['Content-Type'] = 'application/json'
+        return FakeSessionResponse(self.server.request(method, url, headers, data))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+
+def install(server):
+    """ Points the Google Drive clients and sessions created by gdrive_backup at server """
+    from gdrive_backup import drive_pool, stream_download, stream_upload
+
+    class BenchmarkDrive(drive_pool.PooledDrive):
+
+        def get_service_account(self):
+            self.credentials = None
+            return server.service()
+
+    drive_pool.PooledDrive = BenchmarkDrive
+    drive_pool.AuthorizedSession = server.session
+    stream_upload.AuthorizedSession = server.session
+    stream_download.AuthorizedSession = server.session
+    drive_pool.local.__dict__.clear()
+    drive_pool.folders.clear()
@@ -0,0 +1,284 @@
+"""
+Times backups against an in process Google Drive stand in, moto S3 and a local Postgres and counts the Google Drive
+API requests each makes. The results can be saved and compared with the results of a later change
+
+    python benchmarks/harness.py --json before.json
+    python benchmarks/harness.py --compare before.json --latency 0.05 --rate-limit 100
+
+The db benchmark needs pg_dump, psql and a database the user can create a schema in, set with the --db options or the
+PGHOST, PGUSER, PGPASSWORD and PGDATABASE environment variables. It is skipped if the database is not available.
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+from fake_drive import FakeDriveServer, install  # noqa: E402
+
+credentials = json.dumps({'type': 'service_account', 'client_email': 'benchmark@example.com'})
+root_folder = 'benchmark'
+host_id = 'benchmark'
+recipe = [{'hours': 1, 'number': 4},
+          {'days': 1, 'number': 10},
+          {'months': 1, 'number': 36}]
+
+
+class Logger:
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+
+    def info(self, text):
+        if self.verbose:
+            print(f'    {text}')
+
+
+class Benchmark:
+    """ Runs of one benchmark against a fresh Google Drive stand in """
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.logger = Logger(args.verbose)
+        self.server = FakeDriveServer(args.latency, args.bandwidth, args.rate_limit)
+        install(self.server)
+        self.server.add_folder_path(root_folder)
+        self.results = []
+
+    def run(self, run, items, unit, function, size=None):
+        self.server.reset_calls()
+        start = time.time()
+        function()
+        seconds = time.time() - start
+        calls = dict(self.server.calls)
+        result = {'benchmark': self.name, 'run': run, 'items': items, 'unit': unit, 'seconds': round(seconds, 3),
+                  'rate': round(items / seconds, 1) if seconds else None, 'bytes': size,
+                  'requests': calls.pop('requests', 0), 'calls': calls}
+        self.results.append(result)
+        print(result_text(result))
+        return result
+
+
+def result_text(result):
+    text = (f'{result["benchmark"]:8} {result["run"]:24} {result["items"]:7} {result["unit"]:8} '
+            f'{result["seconds"]:8.2f}s {result["rate"] or 0:10.1f}/s {result["requests"]:7} requests')
+    calls = ', '.join(f'{k} {v}' for k, v in sorted(result['calls'].items()))
+    return text + (f' ({calls})' if calls else '')
+
+
+def write_files(directory, files, file_size, per_folder=100):
+    for i in range(files):
+        folder = os.path.join(directory, f'dir_{i // per_folder}')
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f'file_{i}.txt'), 'wb') as f:
+            f.write(os.urandom(file_size))
+
+
+def local_benchmark(args, temp_dir):
+    from gdrive_backup.backup_local_files import BackupLocal
+
+    benchmark = Benchmark('local', args)
+    benchmark.server.add_folder_path(f'{root_folder}/local')
+    source = os.path.join(temp_dir, 'local')
+    write_files(source, args.files, args.file_size)
+    manifest_file = os.path.join(temp_dir, 'manifest.sqlite')
+
+    def backup(manifest=True):
+        BackupLocal(credentials, root_folder, benchmark.logger, args.workers,
+                    manifest_file=manifest_file if manifest else None).backup_to_drive(source, 'local')
+
+    size = args.files * args.file_size
+    benchmark.run('first', args.files, 'files', backup, size)
+    benchmark.run('unchanged', args.files, 'files', backup, size)
+    benchmark.run('unchanged no manifest', args.files, 'files', lambda: backup(False), size)
+    return benchmark.results
+
+
+def s3_benchmark(args, temp_dir):
+    try:
+        import boto3
+        from moto import mock_aws
+    except ImportError:
+        print('s3       skipped, boto3 and moto are needed')
+        return []
+    from gdrive_backup.backup_s3 import BackupS3
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        benchmark = Benchmark('s3', args)
+        benchmark.server.add_folder_path(f'{root_folder}/s3')
+        bucket = boto3.resource('s3').create_bucket(Bucket='benchmark')
+        for i in range(args.objects):
+            bucket.put_object(Key=f'data/dir_{i // 100}/object_{i}', Body=os.urandom(args.object_size))
+        checkpoint_file = os.path.join(temp_dir, 's3_checkpoint.sqlite')
+
+        def backup():
+            BackupS3('key', 'secret', credentials, root_folder, benchmark.logger, args.workers,
+                     checkpoint_file=checkpoint_file).backup('benchmark', 'data', 's3')
+
+        size = args.objects * args.object_size
+        benchmark.run('first', args.objects, 'objects', backup, size)
+        benchmark.run('unchanged', args.objects, 'objects', backup, size)
+    return benchmark.results
+
+
+def seed_backups(server, parent, schemas, backups):
+    """ Hourly backups of each schema in a folder of its own """
+    now = datetime.datetime.utcnow()
+    for schema in schemas:
+        folder = server.add_file(schema, [parent['id']], 'application/vnd.google-apps.folder')
+        for i in range(backups):
+            created = (now - datetime.timedelta(hours=i)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            server.add_file(f'schema_{schema}_{i}.gz', [folder['id']], 'application/x-gzip', createdTime=created,
+                            appProperties={'ip_address': host_id, 'compression': 'gz'})
+
+
+def prune_benchmark(args, temp_dir):
+    from gdrive_backup.backup_db import BackupDb
+
+    benchmark = Benchmark('prune', args)
+    schemas = [f'schema_{i}' for i in range(args.schemas)]
+    items = args.schemas * args.backups
+
+    def backup_db(folder):
+        return BackupDb(credentials, folder, settings.DATABASES['default'], temp_dir, benchmark.logger,
+                        host_id=host_id)
+
+    parent = benchmark.server.add_folder_path(f'{root_folder}/prune')
+    seed_backups(benchmark.server, parent, schemas, args.backups)
+    benchmark.run('schema folders', items, 'backups', lambda: backup_db(parent).prune_schema_folders(schemas, recipe))
+
+    parent = benchmark.server.add_folder_path(f'{root_folder}/prune_each')
+    seed_backups(benchmark.server, parent, schemas, args.backups)
+    folders = [f for f in benchmark.server.files.values() if f['parents'] == [parent['id']]]
+    benchmark.run('each folder', items, 'backups',
+                  lambda: [backup_db(dict(f)).prune_old_backups(recipe) for f in folders])
+    return benchmark.results
+
+
+def database_available():
+    from django.db import connection
+
+    if not (shutil.which('pg_dump') and shutil.which('psql')):
+        return 'pg_dump and psql are needed'
+    try:
+        connection.ensure_connection()
+    except Exception as e:
+        return f'database not available {e!r}'
+
+
+def db_benchmark(args, temp_dir):
+    from django.db import connection
+    from gdrive_backup.backup_db import BackupDb
+
+    reason = database_available()
+    if reason:
+        print(f'db       skipped, {reason}')
+        return []
+    benchmark = Benchmark('db', args)
+    folder = benchmark.server.add_folder_path(f'{root_folder}/db')
+    schema = 'gdrive_backup_benchmark'
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        cursor.execute(f'CREATE SCHEMA {schema}')
+        cursor.execute(f'CREATE TABLE {schema}.rows AS SELECT g AS id, md5(g::text) AS text, now() AS created '
+                       f'FROM generate_series(1, %s) g', [args.rows])
+        cursor.execute(f"SELECT pg_total_relation_size('{schema}.rows')")
+        size = cursor.fetchone()[0]
+    try:
+        for streaming in (False, True):
+            backup = BackupDb(credentials, folder, settings.DATABASES['default'], temp_dir, benchmark.logger,
+                              schema=schema, streaming=streaming, compression=args.compression, host_id=host_id)
+            run = 'streaming' if streaming else 'local file'
+            benchmark.run(f'backup {run}', args.rows, 'rows', backup.backup_db_gdrive, size)
+            benchmark.results[-1]['stages'] = backup.metrics['stages']
+            latest = backup.get_latest_db_backup()
+            benchmark.run(f'restore {run}', args.rows, 'rows', lambda: backup.restore_gdrive_db(latest['id']), size)
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+    return benchmark.results
+
+
+benchmarks = {'local': local_benchmark, 's3': s3_benchmark, 'prune': prune_benchmark, 'db': db_benchmark}
+
+
+def compare(results, previous_file):
+    with open(previous_file) as f:
+        previous = {(r['benchmark'], r['run']): r for r in json.load(f)}
+    print(f'\nCompared with {previous_file}')
+    for r in results:
+        p = previous.get((r['benchmark'], r['run']))
+        if not p:
+            continue
+        change = (r['seconds'] - p['seconds']) / p['seconds'] * 100 if p['seconds'] else 0
+        print(f'{r["benchmark"]:8} {r["run"]:24} {p["seconds"]:8.2f}s -> {r["seconds"]:8.2f}s {change:+6.1f}%  '
+              f'{p["requests"]:7} -> {r["requests"]:7} requests')
+
+
+def configure(args):
+    settings.configure(
+        INSTALLED_APPS=['gdrive_backup'],
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        DATABASES={'default': {'ENGINE': 'django.db.backends.postgresql', 'NAME': args.db_name,
+                               'USER': args.db_user, 'PASSWORD': args.db_password, 'HOST': args.db_host}},
+        BACKUP_HOST_ID=host_id,
+    )
+    django.setup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmarks', nargs='*', help=f'benchmarks to run from {", ".join(benchmarks)}, all by default')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to each Google Drive request')
+    parser.add_argument('--bandwidth', type=float, help='Google Drive bytes per second')
+    parser.add_argument('--rate-limit', type=float, help='Google Drive requests per second before rate limit errors')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--files', type=int, default=2000, help='small files in the local benchmark')
+    parser.add_argument('--file-size', type=int, default=2048)
+    parser.add_argument('--objects', type=int, default=500, help='objects in the s3 benchmark')
+    parser.add_argument('--object-size', type=int, default=64 * 1024)
+    parser.add_argument('--schemas', type=int, default=50, help='schema folders in the prune benchmark')
+    parser.add_argument('--backups', type=int, default=100, help='backups in each schema folder')
+    parser.add_argument('--rows', type=int, default=1000000, help='rows in the db benchmark table')
+    parser.add_argument('--compression', default='gz', choices=['bz2', 'gz', 'zstd'],
+                        help='compression of the db benchmark')
+    parser.add_argument('--db-name', default=os.environ.get('PGDATABASE', 'postgres'))
+    parser.add_argument('--db-user', default=os.environ.get('PGUSER', 'postgres'))
+    parser.add_argument('--db-password', default=os.environ.get('PGPASSWORD', ''))
+    parser.add_argument('--db-host', default=os.environ.get('PGHOST', 'localhost'))
+    parser.add_argument('--json', help='file to save the results in')
+    parser.add_argument('--compare', help='results file saved by a previous run to compare with')
+    parser.add_argument('--verbose', action='store_true', help='show the backup log')
+    args = parser.parse_args()
+    unknown = [b for b in args.benchmarks if b not in benchmarks]
+    if unknown:
+        parser.error(f'unknown benchmarks {", ".join(unknown)}')
+    configure(args)
+
+    results = []
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for name in args.benchmarks or benchmarks:
+            results += benchmarks[name](args, temp_dir)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Times the retention engine on synthetic backups and checks it keeps the same backups as the previous implementation
+
+    python benchmarks/prune_benchmark.py --backups 100000
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gdrive_backup.prune_backups import PruneBackups, select_removals  # noqa: E402
+
+recipe = [{'hours': 1, 'number': 4},
+          {'hours': 2, 'number': 10},
+          {'days': 1, 'number': 10},
+          {'months': 1, 'number': 36}]
+
+
+class PreviousPruneBackups:
+    """ Implementation before the retention engine, rebuilding the periods for every line of the recipe """
+
+    def __init__(self, backup_dict, now):
+        self.keep = []
+        self.backup_dict = backup_dict
+        self.now = now
+
+    def backups_to_remove(self, recipe_lines):
+        for r in recipe_lines:
+            if 'months' in r:
+                self.keep_monthly_backups(r['months'], r['number'])
+            elif 'days' in r:
+                self.keep_backups(datetime.timedelta(days=r['days']), r['number'])
+            elif 'hours' in r:
+                self.keep_backups(datetime.timedelta(hours=r['hours']), r['number'])
+        return {k: v for k, v in self.backup_dict.items() if k not in self.keep}
+
+    def keep_backups(self, period, number):
+        period_dict = {}
+        start_time = datetime.datetime(2000, 1, 1) + int((self.now - datetime.datetime(2000, 1, 1)) /
+                                                         period) * period + period
+        for b in self.backup_dict:
+            period_dict.setdefault(int((start_time - b) / period), []).append(b)
+        for k in sorted(period_dict.keys()):
+            self.keep.append(max(period_dict[k]))
+            number -= 1
+            if number < 1:
+                break
+
+    def keep_monthly_backups(self, period, number):
+        period_dict = {}
+        for b in self.backup_dict:
+            period_dict.setdefault(int(int(b.strftime('%Y%m')) / period), []).append(b)
+        for k in sorted(period_dict.keys(), reverse=True):
+            self.keep.append(max(period_dict[k]))
+            number -= 1
+            if number < 1:
+                break
+
+
+def synthetic_backups(number, now, interval):
+    return {now - i * interval: {'id': str(i), 'name': f'backup_{i}', 'createdTime': now - i * interval}
+            for i in range(number)}
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backups', type=int, default=100000)
+    parser.add_argument('--interval_minutes', type=int, default=10)
+    parser.add_argument('--skip_previous', action='store_true', default=False)
+    args = parser.parse_args()
+
+    now = datetime.datetime(2024, 6, 15, 12, 30)
+    backup_dict = synthetic_backups(args.backups, now, datetime.timedelta(minutes=args.interval_minutes))
+    removal, elapsed = timed(lambda: PruneBackups(backup_dict, now).backups_to_remove(recipe))
+    print(f'{args.backups} backups: keep {args.backups - len(removal)}, remove {len(removal)} in {elapsed:.3f}s')
+
+    _, elapsed = timed(lambda: select_removals(list(backup_dict.values()), recipe, now))
+    print(f'select_removals including differential bases in {elapsed:.3f}s')
+
+    if not args.skip_previous:
+        previous, elapsed = timed(lambda: PreviousPruneBackups(backup_dict, now).backups_to_remove(recipe))
+        print(f'previous implementation in {elapsed:.3f}s')
+        if set(previous) != set(removal):
+            raise SystemExit('Kept backups differ from the previous implementation')
+        print('Kept backups match the previous implementation')
+
+
+if __name__ == '__main__':
+    main()
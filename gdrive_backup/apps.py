@@ -3,3 +3,4 @@ from django.apps import AppConfig
 
 class ModalConfig(AppConfig):
     name = 'gdrive_backup'
+    default_auto_field = 'django.db.models.AutoField'
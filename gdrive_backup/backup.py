@@ -1,11 +1,21 @@
 import logging
+import os
 from tempfile import gettempdir
 
 from django.conf import settings
 from encrypted_credentials import django_credentials
-from .backup_db import BackupDb
+from .backup_db import BackupDb, host_id_file, read_signatures
 from .backup_local_files import BackupLocal
-from .sql_functions import get_schemas
+from .catalog import get_catalog
+from .chunk_store import ChunkStore
+from .compression import get_codec
+from .drive_cache import invalidate
+from .drive_pool import get_drive, find_create_folder
+from .host_identity import get_host_id
+from .run_history import RunHistory
+from .schema_backup import SchemaBackups, StageLimits
+from .sql_functions import exported_snapshot
+from .stream_upload import DEFAULT_CHUNK_SIZE
 
 try:
     from .backup_s3 import BackupS3
@@ -18,40 +28,176 @@ class Backup:
 
     def __init__(self, logger=None):
         self.logger = logger if logger else logging.getLogger(__name__)
+        self._chunk_store = None
+        # Progress metrics of each database backup taken
+        self.metrics = []
+        self.history = RunHistory(self.logger, enabled=getattr(settings, 'BACKUP_RUN_HISTORY', True),
+                                  keep_days=getattr(settings, 'BACKUP_RUN_HISTORY_DAYS', 365))
 
-    def get_backup_db(self, schema=None, table=None, sub_folder=None):
-        google_directory = getattr(settings, 'BACKUP_GDRIVE_DB', settings.BACKUP_GDRIVE_DIR + '/db')
-        if sub_folder:
-            google_directory += '/' + sub_folder
-        elif schema:
-            google_directory += '/' + schema
-        return BackupDb(django_credentials.get_credentials('drive'),
-                        google_directory,
+    @staticmethod
+    def host_id():
+        return get_host_id(getattr(settings, 'BACKUP_HOST_ID', None),
+                           os.path.join(getattr(settings, 'BACKUP_LOCAL_DB_DIR', gettempdir()), host_id_file))
+
+    def add_metrics(self, metrics):
+        self.metrics += metrics
+        self.history.add_metrics(metrics)
+
+    @staticmethod
+    def db_folder_path():
+        return getattr(settings, 'BACKUP_GDRIVE_DB', settings.BACKUP_GDRIVE_DIR + '/db')
+
+    def get_backup_db(self, schema=None, table=None, sub_folder=None, drive=None, limits=None, folder=None,
+                      snapshot=None, snapshot_signatures=None):
+        """
+        :param folder: Google Drive folder dictionary to use instead of looking up the schema or sub_folder folder
+        :param snapshot_signatures: table signatures read before snapshot was exported
+        """
+        google_credentials = django_credentials.get_credentials('drive')
+        drive = drive if drive else get_drive(google_credentials)
+        if not folder:
+            path = self.db_folder_path()
+            if sub_folder:
+                path += '/' + sub_folder
+            elif schema:
+                path += '/' + schema
+            folder = find_create_folder(drive, path, shared_with_me=True)
+        return BackupDb(google_credentials,
+                        folder,
                         settings.DATABASES['default'],
                         getattr(settings, 'BACKUP_LOCAL_DB_DIR', gettempdir()),
                         self.logger,
                         schema=schema,
-                        table=table)
+                        table=table,
+                        streaming=getattr(settings, 'BACKUP_DB_STREAMING', False),
+                        chunk_size=getattr(settings, 'BACKUP_UPLOAD_CHUNK_SIZE', DEFAULT_CHUNK_SIZE),
+                        compression=get_codec(**getattr(settings, 'BACKUP_COMPRESSION', {})),
+                        db_format=getattr(settings, 'BACKUP_DB_FORMAT', 'plain'),
+                        jobs=getattr(settings, 'BACKUP_DB_JOBS', os.cpu_count() or 1),
+                        directory_upload=getattr(settings, 'BACKUP_DB_DIRECTORY_UPLOAD', 'archive'),
+                        resume_max_age=getattr(settings, 'BACKUP_RESUME_MAX_AGE', 12 * 60 * 60),
+                        drive=drive,
+                        limits=limits,
+                        snapshot=snapshot,
+                        snapshot_signatures=snapshot_signatures,
+                        incremental_file=self.incremental_file(),
+                        full_interval=getattr(settings, 'BACKUP_DB_FULL_INTERVAL', 24 * 60 * 60),
+                        stats_delay=getattr(settings, 'BACKUP_DB_STATS_DELAY', 10),
+                        chunk_store=self.chunk_store(),
+                        host_id=getattr(settings, 'BACKUP_HOST_ID', None),
+                        table_format=getattr(settings, 'BACKUP_DB_TABLE_FORMAT', 'sql'),
+                        rebuild_indexes=getattr(settings, 'BACKUP_DB_REBUILD_INDEXES', False),
+                        progress_interval=getattr(settings, 'BACKUP_PROGRESS_INTERVAL', 2),
+                        upload_retries=getattr(settings, 'BACKUP_UPLOAD_RETRIES', 3))
+
+    def backup_schemas(self, schemas, table=None, sub_folder=None, sizes=None):
+        """ :param sizes: dictionary of schema to its size for progress reporting """
+        concurrency = getattr(settings, 'BACKUP_SCHEMA_CONCURRENCY', {})
+        limits = StageLimits(db_connections=concurrency.get('db_connections', 2),
+                             compression=concurrency.get('compression', os.cpu_count() or 1),
+                             uploads=concurrency.get('uploads', 4))
+        schema_backups = SchemaBackups(self, django_credentials.get_credentials('drive'), self.db_folder_path(),
+                                       workers=concurrency.get('workers', 4), limits=limits)
+        try:
+            if getattr(settings, 'BACKUP_DB_SNAPSHOT', False):
+                # Read before the snapshot so full backups of the schemas can become bases of differential backups
+                signatures = read_signatures() if self.incremental_file() else None
+                with exported_snapshot() as snapshot:
+                    self.logger.info(f'Backing up schemas from snapshot {snapshot}')
+                    return schema_backups.run(schemas, table, sub_folder, snapshot, sizes, signatures)
+            return schema_backups.run(schemas, table, sub_folder, sizes=sizes)
+        finally:
+            # Including the schemas that succeeded when others failed
+            self.add_metrics([r['metrics'] for r in schema_backups.results if r['metrics']])
+            # Also after a failure as the retention recipe always keeps the newest backups
+            if not sub_folder:
+                with self.history.stage('prune'):
+                    self.prune_schemas(schemas)
+
+    def prune_schemas(self, schemas=None, dry_run=False):
+        """ Prunes every schema folder with BACKUP_DB_RETENTION in one operation """
+        schemas = schemas if schemas is not None else [s[0] for s in get_catalog(use_cache=False).schemas()]
+        return self.get_backup_db().prune_schema_folders(schemas, settings.BACKUP_DB_RETENTION, dry_run)
+
+    @staticmethod
+    def local_manifest_file():
+        if getattr(settings, 'BACKUP_LOCAL_MANIFEST', True):
+            return os.path.join(getattr(settings, 'BACKUP_LOCAL_DB_DIR', gettempdir()),
+                                'gdrive_backup_manifest.sqlite3')
+
+    def chunk_store(self):
+        """ Single chunk store shared by all the database backups """
+        if self._chunk_store is None:
+            dedup = getattr(settings, 'BACKUP_DEDUP', {})
+            references_file = os.path.join(getattr(settings, 'BACKUP_LOCAL_DB_DIR', gettempdir()),
+                                           'gdrive_backup_chunk_refs.sqlite3')
+            self._chunk_store = ChunkStore(django_credentials.get_credentials('drive'),
+                                           self.db_folder_path() + '/_chunks',
+                                           get_codec(**getattr(settings, 'BACKUP_COMPRESSION', {})),
+                                           average_size=dedup.get('average_size', 1024 * 1024),
+                                           workers=dedup.get('workers', 4),
+                                           touch_interval=dedup.get('touch_interval', 6 * 60 * 60),
+                                           logger=self.logger,
+                                           references_file=references_file)
+        return self._chunk_store
+
+    @staticmethod
+    def incremental_file():
+        if getattr(settings, 'BACKUP_DB_INCREMENTAL', False):
+            return os.path.join(getattr(settings, 'BACKUP_LOCAL_DB_DIR', gettempdir()),
+                                'gdrive_backup_incremental.sqlite3')
+
+    @staticmethod
+    def s3_checkpoint_file():
+        if getattr(settings, 'S3_BACKUP_CHECKPOINT', True):
+            return os.path.join(getattr(settings, 'BACKUP_LOCAL_DB_DIR', gettempdir()),
+                                'gdrive_backup_s3_checkpoint.sqlite3')
 
     def backup_db_and_folders(self, schema=None, table=None, include_db=True, all_schemas=False,
                               include_folders=True, include_s3_folders=True, sub_folder=None):
-        if include_db:
-            schemas = [s[0] for s in get_schemas()] if all_schemas else [schema]
-            for s in schemas:
-                db = self.get_backup_db(s, table, sub_folder)
+        """ Recorded as a BackupRun with the time and bytes of each stage """
+        with self.history.record(self.host_id(), schema, table, include_db and all_schemas):
+            self.run_backups(schema, table, include_db, all_schemas, include_folders, include_s3_folders, sub_folder)
+
+    def run_backups(self, schema, table, include_db, all_schemas, include_folders, include_s3_folders, sub_folder):
+        if include_db and all_schemas:
+            catalog = get_catalog(use_cache=False)
+            self.backup_schemas(catalog.largest_first(), table, sub_folder,
+                                sizes={s: size for s, size in catalog.schemas()})
+        elif include_db:
+            db = self.get_backup_db(schema, table, sub_folder)
+            try:
                 db.backup_db_gdrive()
-                if not sub_folder:
+            finally:
+                self.add_metrics([db.metrics])
+            if not sub_folder:
+                with self.history.stage('prune', db.backup_name()):
                     db.prune_old_backups(settings.BACKUP_DB_RETENTION)
+        if include_db and not sub_folder and getattr(settings, 'BACKUP_DB_FORMAT', 'plain') == 'chunked':
+            with self.history.stage('collect_garbage'):
+                self.chunk_store().collect_garbage(getattr(settings, 'BACKUP_DEDUP', {}).get('grace', 24 * 60 * 60))
+        if include_db:
+            invalidate()
 
         if include_folders and hasattr(settings, 'BACKUP_DIRS'):
-            b = BackupLocal(django_credentials.get_credentials('drive'), settings.BACKUP_GDRIVE_DIR, self.logger)
+            b = BackupLocal(django_credentials.get_credentials('drive'), settings.BACKUP_GDRIVE_DIR, self.logger,
+                            workers=getattr(settings, 'BACKUP_UPLOAD_WORKERS', 8),
+                            hash_workers=getattr(settings, 'BACKUP_HASH_WORKERS', 4),
+                            manifest_file=self.local_manifest_file())
             for backup in settings.BACKUP_DIRS:
-                b.backup_to_drive(*backup)
+                with self.history.stage('folders', backup[0]):
+                    b.backup_to_drive(*backup)
 
         if include_s3_folders and hasattr(settings, 'S3_BACKUP_DIRS'):
             s3_backup = BackupS3(settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY,
                                  django_credentials.get_credentials('drive'),
                                  settings.BACKUP_GDRIVE_DIR,
-                                 self.logger)
+                                 self.logger,
+                                 workers=getattr(settings, 'S3_BACKUP_WORKERS', 4),
+                                 range_size=getattr(settings, 'S3_BACKUP_RANGE_SIZE', 8 * 1024 * 1024),
+                                 read_ahead=getattr(settings, 'S3_BACKUP_READ_AHEAD', 2),
+                                 checkpoint_file=self.s3_checkpoint_file(),
+                                 mirror_deletes=getattr(settings, 'S3_BACKUP_MIRROR_DELETES', False))
             for s3 in settings.S3_BACKUP_DIRS:
-                s3_backup.backup(settings.AWS_PRIVATE_STORAGE_BUCKET_NAME, *s3)
+                with self.history.stage('s3', s3[0]):
+                    s3_backup.backup(settings.AWS_PRIVATE_STORAGE_BUCKET_NAME, *s3)
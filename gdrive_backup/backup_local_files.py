@@ -1,33 +1,85 @@
 import os
 from .base_backup import BaseBackup
+from .drive_index import DriveTreeIndex
+from .drive_pool import find_create_folder
+from .manifest import FileManifest
+from .upload_pool import UploadPool
 
 
 class BackupLocal(BaseBackup):
 
+    def __init__(self, google_credentials, base_backup_dir, logger, workers=8, hash_workers=4, manifest_file=None):
+        """
+        :param manifest_file: Optional sqlite file recording files already backed up so unchanged files are skipped
+        """
+        super().__init__(google_credentials, base_backup_dir, logger)
+        self.workers = workers
+        self.hash_workers = hash_workers
+        self.manifest_file = manifest_file
+
     def backup_to_drive(self, source_dir, google_drive_dir):
+        pool = UploadPool(self.google_credentials, self.logger, self.workers, self.hash_workers)
+        manifest = FileManifest(self.manifest_file) if self.manifest_file else None
+        # Only loaded if a changed file is found
+        index = DriveTreeIndex(self.drive,
+                               lambda: find_create_folder(self.drive, google_drive_dir, folder=self.base_backup_dir))
+        try:
+            self.backup_dir_to_drive(pool, manifest, index, source_dir, google_drive_dir, '')
+        finally:
+            try:
+                pool.join()
+            finally:
+                if manifest:
+                    manifest.close()
+
+    @staticmethod
+    def get_existing_file_ids(index, path):
+        """ :return: dictionary of file name to a dictionary of md5: google file id """
+        file_ids = {}
+        for f in index.files_in(path):
+            file_ids.setdefault(f['name'], {})[f.get('md5Checksum')] = f['id']
+        return file_ids
+
+    def backup_dir_to_drive(self, pool, manifest, index, source_dir, google_drive_dir, path):
         self.logger.info(f'Backing up {source_dir} to {google_drive_dir}')
-        gdrive_backup_dir = self.drive.find_create_folder(google_drive_dir, folder=self.base_backup_dir)
-        file_hashes = self.get_file_hashes(gdrive_backup_dir)
-        for f in os.listdir(source_dir):
-            full_filename = os.path.join(source_dir, f)
-            if os.path.isfile(full_filename):
-                if self.md5sum(full_filename) not in file_hashes.get(full_filename, []):
-                    self.logger.info('Backup - ' + f)
-                    with open(full_filename, 'rb') as backup_stream:
-                        self.drive.create_file_stream(full_filename, gdrive_backup_dir, backup_stream)
+        changed = []
+        unchanged = 0
+        for entry in os.scandir(source_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                record = manifest.get(google_drive_dir, entry.path) if manifest else None
+                if manifest and manifest.unchanged(record, stat) and record[4]:
+                    unchanged += 1
                 else:
-                    self.logger.info('    Exists - ' + f)
-            elif os.path.isdir(full_filename):
-                self.backup_to_drive(full_filename, google_drive_dir + '/' + f)
+                    md5 = record[3] if manifest and manifest.unchanged(record, stat) else None
+                    changed.append((entry, stat, md5))
+            elif entry.is_dir():
+                self.backup_dir_to_drive(pool, manifest, index, entry.path, google_drive_dir + '/' + entry.name,
+                                         f'{path}/{entry.name}' if path else entry.name)
+        if unchanged:
+            self.logger.info(f'    Unchanged - {unchanged} files')
+        if not changed:
+            return
+        gdrive_backup_dir = index.find_create_folder(path)
+        file_ids = self.get_existing_file_ids(index, path)
+        for entry, stat, md5 in changed:
+            callback = self.manifest_callback(manifest, google_drive_dir, entry.path, stat) if manifest else None
+            pool.submit(entry.path, gdrive_backup_dir, file_ids.get(entry.path, {}), entry.name, md5, callback)
+
+    @staticmethod
+    def manifest_callback(manifest, destination, path, stat):
+        def callback(md5, drive_id):
+            manifest.set(destination, path, stat, md5, drive_id)
+        return callback
 
-    def restore_gdrive_folder(self, g_drive_folder_name, destination_root):
-        folder_id = self.drive.get_folder(g_drive_folder_name, folder=self.base_backup_dir)
-        files = self.drive.file_list(q=self.drive.build_q(folder=folder_id))
+    def restore_gdrive_folder(self, g_drive_folder_name, destination_root, index=None, path=''):
+        if index is None:
+            index = DriveTreeIndex(self.drive, self.drive.get_folder(g_drive_folder_name, folder=self.base_backup_dir))
         folder = f'{destination_root}/{g_drive_folder_name}'
         if not os.path.exists(folder):
             os.mkdir(folder)
-        for f in files:
-            if f.get('mimeType') == 'application/vnd.google-apps.folder':
-                self.restore_gdrive_folder(f'{g_drive_folder_name}/{f["name"]}', destination_root)
-            else:
-                self.drive.get_file_contents(file_id=f['id'], local_folder=folder)
+        for sub_folder in index.sub_folders(path):
+            self.restore_gdrive_folder(f'{g_drive_folder_name}/{sub_folder.split("/")[-1]}', destination_root,
+                                       index, sub_folder)
+        for f in index.files_in(path):
+            self.drive.get_file_contents(file_id=f['id'], local_folder=folder)
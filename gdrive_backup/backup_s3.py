@@ -1,33 +1,51 @@
 import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
 import hashlib
-from google_client.drive import GoogleDrive
 from .base_backup import BaseBackup
+from .batch import trash_files, failures, BatchError
+from .drive_index import DriveTreeIndex
+from .drive_pool import get_drive, find_create_folder
+from .manifest import S3Checkpoint
+from .rate_limit import call_with_backoff
+from .upload_pool import UploadPoolError
+
+
+class S3ReadError(Exception):
+    pass
 
 
 class S3File(io.RawIOBase):
     """
     Binary steam to access S3 files. Provides seek and read a variable number of bytes.
+    Reads are served from ranges of range_size fetched ahead of the reader on a thread pool so the many small reads
+    of the uploader do not each make a request. At most read_ahead + 1 ranges are held in memory.
     """
 
-    # class Buffer:
-    #    def __init__(self, size):
-    #        self.nbytes = size
-
-    # def getbuffer(self):
-    #    return self.Buffer(self.size)
-
-    def __init__(self, s3_object):
+    def __init__(self, s3_object, size=None, range_size=8 * 1024 * 1024, read_ahead=2, e_tag=None):
+        """ :param e_tag: ETag the object is expected to have, reads fail if it is overwritten while being read """
         self.s3_object = s3_object
+        self.e_tag = e_tag
+        # The client is thread safe unlike the resource
+        self.client = s3_object.meta.client
         self.position = 0
         self.md5 = hashlib.md5(b'')
+        self._size = size
+        self.range_size = range_size
+        self.read_ahead = read_ahead
+        self.ranges = {}
+        self.executor = ThreadPoolExecutor(max_workers=max(read_ahead, 1))
 
     def __repr__(self):
         return "<%s s3_object=%r>" % (type(self).__name__, self.s3_object)
 
     @property
     def size(self):
-        return self.s3_object.content_length
+        if self._size is None:
+            self._size = self.s3_object.content_length
+        return self._size
 
     def tell(self):
         return self.position
@@ -48,81 +66,146 @@ class S3File(io.RawIOBase):
     def seekable(self):
         return True
 
+    def get_range(self, index):
+        start = index * self.range_size
+        end = min(start + self.range_size, self.size) - 1
+        kwargs = {'IfMatch': self.e_tag} if self.e_tag else {}
+        data = self.client.get_object(Bucket=self.s3_object.bucket_name, Key=self.s3_object.key,
+                                      Range=f'bytes={start}-{end}', **kwargs)['Body'].read()
+        if len(data) != end - start + 1:
+            raise S3ReadError(f'{self.s3_object.key} returned {len(data)} bytes for range {start}-{end}, '
+                              f'changed while being read')
+        return data
+
+    def range_data(self, index):
+        last = (self.size - 1) // self.range_size
+        for i in list(self.ranges):
+            if i < index or i > index + self.read_ahead:
+                self.ranges.pop(i).cancel()
+        for i in range(index, min(index + self.read_ahead, last) + 1):
+            if i not in self.ranges:
+                self.ranges[i] = self.executor.submit(self.get_range, i)
+        return self.ranges[index].result()
+
     def read(self, size=-1):
         if self.position >= self.size:
-            return
-        if size == -1:
-            range_header = f'bytes={self.position}'
-            self.seek(offset=0, whence=io.SEEK_END)
-        else:
-            new_position = self.position + size
-            if new_position >= self.size:
-                return self.read()
-            range_header = f'bytes={self.position}-{new_position - 1}'
-            self.seek(offset=size, whence=io.SEEK_CUR)
-        data = self.s3_object.get(Range=range_header)["Body"].read()
-        self.md5.update(data)
-        return data
+            return b''
+        if size < 0 or self.position + size > self.size:
+            size = self.size - self.position
+        output = bytearray()
+        while len(output) < size:
+            index = self.position // self.range_size
+            offset = self.position - index * self.range_size
+            data = self.range_data(index)[offset:offset + size - len(output)]
+            if not data:
+                raise S3ReadError(f'Read of {self.s3_object.key} ended at {self.position} of {self.size} bytes')
+            output += data
+            self.position += len(data)
+        self.md5.update(output)
+        return bytes(output)
 
     def readable(self):
         return True
 
+    def close(self):
+        for f in self.ranges.values():
+            f.cancel()
+        self.ranges = {}
+        self.executor.shutdown(wait=False)
+        super().close()
+
 
 class BackupFolders:
     """
-    Keeps dictionary of Google Drive folders along with file S3 ETag hashes
+    Google Drive folders along with file S3 ETag hashes from a single index of the destination folder tree.
+    The index is only loaded when existing files need to be checked, otherwise folders are looked up individually.
     """
 
     def __init__(self, backup, base_folder):
         self.base_folder = base_folder
         self.backup = backup
-        self.folders = \
-            {'/': {'hashes': backup.get_file_hashes(base_folder),
-                   'folder': backup.drive.find_create_folder(base_folder, folder=backup.base_backup_dir['id'])}
-             }
+        self._root = None
+        self.index = DriveTreeIndex(backup.drive, lambda: self.root)
+        self.files = {}
+        self.parents = {}
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = find_create_folder(self.backup.drive, self.base_folder, folder=self.backup.base_backup_dir)
+        return self._root
 
-    def add_folder(self, folder):
-        return {
-            'hashes': self.backup.get_file_hashes(self.base_folder + '/' + folder),
-            'folder': self.backup.drive.find_create_folder(folder, folder=self.folders['/']['folder']),
-        }
+    def find_file(self, folder, file, file_hash):
+        if folder not in self.files:
+            self.files[folder] = {(f['name'], self.backup.get_s3_hash(f)): f for f in self.index.files_in(folder)}
+        return self.files[folder].get((file, file_hash))
 
     def file_exists(self, folder, file, file_hash):
         if file == '':
             return True
-        if folder not in self.folders:
-            self.folders[folder] = self.add_folder(folder)
-        return file_hash in self.folders[folder]['hashes'].get(file, [])
+        return self.find_file(folder, file, file_hash) is not None
 
     def parent(self, folder):
-        return self.folders[folder]['folder']
+        if self.index.loaded:
+            return self.index.find_create_folder(folder)
+        if folder not in self.parents:
+            if folder == '/':
+                self.parents[folder] = self.root
+            else:
+                self.parents[folder] = find_create_folder(self.backup.drive, folder, folder=self.root)
+        return self.parents[folder]
 
 
 class BackupS3(BaseBackup):
     """
     Copies files from a folder and sub folders in an S3 bucket to Google Drive.
-    Will skip files where the S3 ETag matches the value in the google appProperties ETag
+    Will skip files where the S3 ETag matches the value in the google appProperties ETag.
+    Objects are copied concurrently by workers threads each reading ranges of range_size with read_ahead ranges
+    prefetched. For many small objects increase workers, for large objects increase range_size and read_ahead.
     """
 
-    def __init__(self, access_key_id, access_key, google_credentials, backup_dir, logger):
+    def __init__(self, access_key_id, access_key, google_credentials, backup_dir, logger, workers=4,
+                 range_size=8 * 1024 * 1024, read_ahead=2, checkpoint_file=None, mirror_deletes=False):
+        """
+        :param checkpoint_file: Optional sqlite file recording the objects already copied
+        :param mirror_deletes: Trash the Google Drive copy of objects deleted from S3
+        """
         super().__init__(google_credentials, backup_dir, logger)
+        self.checkpoint_file = checkpoint_file
+        self.mirror_deletes = mirror_deletes
         self.s3 = boto3.resource('s3',  aws_access_key_id=access_key_id,  aws_secret_access_key=access_key)
-        self._google_drive = None
-        self.google_credentials = google_credentials
+        self.workers = workers
+        self.range_size = range_size
+        self.read_ahead = read_ahead
+        self.lock = threading.Lock()
 
     @property
     def google_drive(self):
-        if not self._google_drive:
-            self._google_drive = GoogleDrive(self.google_credentials)
-        return self._google_drive
+        """ Shared client of the current worker thread """
+        return get_drive(self.google_credentials)
+
+    @staticmethod
+    def get_s3_hash(google_file):
+        return google_file.get('appProperties', {}).get('ETag')
 
-    def get_file_hashes(self, dir_name,
-                        get_hash=lambda google_file: google_file.get('appProperties', {}).get('ETag'),
-                        extra_query=None):
-        return super().get_file_hashes(dir_name, get_hash)
+    def get_file_hashes(self, dir_name, get_hash=None, extra_query=None):
+        return super().get_file_hashes(dir_name, get_hash or self.get_s3_hash)
+
+    def info(self, text):
+        with self.lock:
+            self.logger.info(text)
+
+    def copy_object(self, s3_object, size, e_tag, filename, parent):
+        self.info(f'Backing up {s3_object.key}')
+        with S3File(s3_object, size, self.range_size, self.read_ahead, e_tag) as s3_file:
+            return call_with_backoff(self.google_drive.create_file_stream, filename, parent, s3_file,
+                                     body={'appProperties': {'ETag': e_tag}})
 
     def backup(self, bucket_name, prefix, destination):
         """ Backup from a S3 prefix (folder) to google drive
+        With a checkpoint file only objects whose ETag has changed since the last run are copied and Google Drive is
+        only listed on the first run. Objects deleted from S3 are reported and trashed if mirror_deletes is set.
+        Renamed objects are copied within Google Drive rather than copied again from S3.
         :param bucket_name:
         :param prefix:  consider like a folder with no trailing /
         :param destination:
@@ -130,16 +213,79 @@ class BackupS3(BaseBackup):
         """
 
         folders = BackupFolders(self, destination)
-        bucket = self.s3.Bucket(name=bucket_name)
-        for f in bucket.objects.filter(Prefix=prefix):
-            filename = f.key.split('/')[-1]
-            path = f.key[len(prefix) + 1:-1*(len(filename) + 1)]
-            if path == '':
-                path = '/'
-            if not folders.file_exists(path, filename, f.e_tag):
-                self.logger.info(f'Backing up {f.key}')
-                s3_file = S3File(self.s3.Object(bucket_name, f.key))
-                self.google_drive.create_file_stream(filename, folders.parent(path), s3_file,
-                                                     body={'appProperties': {'ETag': f.e_tag}})
-            else:
-                self.logger.info(f'found {f.key}')
+        checkpoint = S3Checkpoint(self.checkpoint_file) if self.checkpoint_file else None
+        try:
+            synced = checkpoint.get_objects(destination, bucket_name, prefix) if checkpoint else {}
+            changed = []
+            listed = set()
+            for f in self.s3.Bucket(name=bucket_name).objects.filter(Prefix=prefix):
+                listed.add(f.key)
+                record = synced.get(f.key)
+                if record and record[0] == f.e_tag and record[3]:
+                    continue
+                filename = f.key.split('/')[-1]
+                if filename:
+                    path = f.key[len(prefix) + 1:-1*(len(filename) + 1)]
+                    changed.append((f, filename, path if path else '/'))
+            deleted = {k: v for k, v in synced.items() if k not in listed}
+            self.info(f'{len(listed) - len(changed)} unchanged, {len(changed)} changed, {len(deleted)} deleted')
+            self.copy_changed(bucket_name, destination, folders, checkpoint, changed, deleted, check_drive=not synced)
+            for key in deleted:
+                self.info(f'Deleted from S3 - {key}')
+            failed = {}
+            if self.mirror_deletes:
+                failed = failures(trash_files(self.drive, [r[3] for r in deleted.values() if r[3]]))
+                for file_id, error in failed.items():
+                    self.info(f'Failed to trash {file_id} {error}')
+            for key, record in deleted.items():
+                if record[3] not in failed:
+                    checkpoint.delete(destination, bucket_name, key)
+            if failed:
+                raise BatchError(f'{len(failed)} copies of objects deleted from S3 could not be trashed')
+        finally:
+            if checkpoint:
+                checkpoint.close()
+
+    def copy_changed(self, bucket_name, destination, folders, checkpoint, changed, deleted, check_drive):
+        """
+        :param check_drive: Check the Google Drive folder for an existing copy as there is no checkpoint
+        """
+        renamed = {(v[0], v[1]): k for k, v in deleted.items() if v[3]}
+        queued = threading.BoundedSemaphore(self.workers * 2)
+        futures = []
+
+        def record(f, google_file):
+            if checkpoint:
+                checkpoint.set(destination, bucket_name, f.key, f.e_tag, f.size, f.last_modified, google_file['id'])
+
+        def copy_done(f):
+            def callback(future):
+                queued.release()
+                if not future.exception():
+                    record(f, future.result())
+            return callback
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for f, filename, path in changed:
+                existing = folders.find_file(path, filename, f.e_tag) if check_drive else None
+                old_key = renamed.pop((f.e_tag, f.size), None)
+                if existing:
+                    self.info(f'found {f.key}')
+                    record(f, existing)
+                elif old_key:
+                    self.info(f'Renamed {old_key} to {f.key}')
+                    record(f, call_with_backoff(self.drive.service.files().copy(
+                        fileId=deleted[old_key][3], supportsAllDrives=True,
+                        body={'name': filename, 'parents': [folders.parent(path)['id']],
+                              'appProperties': {'ETag': f.e_tag}}).execute))
+                else:
+                    queued.acquire()
+                    future = executor.submit(self.copy_object, self.s3.Object(bucket_name, f.key), f.size, f.e_tag,
+                                             filename, folders.parent(path))
+                    future.add_done_callback(copy_done(f))
+                    futures.append((f.key, future))
+        failed = [(key, future.exception()) for key, future in futures if future.exception()]
+        for key, error in failed:
+            self.info(f'Failed - {key} {error!r}')
+        if failed:
+            raise UploadPoolError(f'{len(failed)} S3 objects failed to copy')
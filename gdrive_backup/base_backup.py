@@ -1,20 +1,30 @@
 import os
 import hashlib
-from google_client.drive import GoogleDrive
+
+from .batch import get_files
+from .drive_pool import get_drive, find_create_folder
 
 
 class BaseBackup:
 
-    def __init__(self, google_credentials, base_backup_dir, logger):
-        self.drive = GoogleDrive(google_credentials)
+    def __init__(self, google_credentials, base_backup_dir, logger, drive=None):
+        """
+        :param base_backup_dir: Path of the Google Drive folder or a folder dictionary already looked up
+        :param drive: Optional GoogleDrive client to use instead of the shared client of the current thread
+        """
+        self.google_credentials = google_credentials
+        self.drive = drive if drive else get_drive(google_credentials)
         self.logger = logger
-        self.base_backup_dir = self.drive.find_create_folder(base_backup_dir, shared_with_me=True)
+        if type(base_backup_dir) == dict:
+            self.base_backup_dir = base_backup_dir
+        else:
+            self.base_backup_dir = find_create_folder(self.drive, base_backup_dir, shared_with_me=True)
 
     def get_existing_backup_files(self, google_drive_dir, extra_query=None):
         if not extra_query:
             extra_query = {}
         if type(google_drive_dir) != dict:
-            gdrive_backup_dir = self.drive.find_create_folder(google_drive_dir, folder=self.base_backup_dir)
+            gdrive_backup_dir = find_create_folder(self.drive, google_drive_dir, folder=self.base_backup_dir)
         else:
             gdrive_backup_dir = google_drive_dir
         return self.drive.file_list(q=self.drive.build_q(folder=gdrive_backup_dir['id'], **extra_query))
@@ -47,9 +57,21 @@ class BaseBackup:
         return file_hash.hexdigest()
 
     def check_upload(self, google_file, local_file):
-        saved_file = self.drive.service.files().get(fileId=google_file['id'], fields='size, md5Checksum').execute()
-        md5 = self.md5sum(local_file)
-        file_length = os.path.getsize(local_file)
-        if md5 == saved_file['md5Checksum'] and file_length == int(saved_file['size']):
-            return True
-        return False
+        return self.check_upload_hash(google_file, self.md5sum(local_file), os.path.getsize(local_file))
+
+    def check_upload_hash(self, google_file, md5, file_length):
+        return not self.check_uploads([(google_file, md5, file_length)])
+
+    def check_uploads(self, uploads):
+        """
+        Looks up the size and md5 of many uploaded files in batched requests
+        :param uploads: list of (google_file, md5, file_length)
+        :return: list of the google files that could not be found or do not match
+        """
+        results = get_files(self.drive, [u[0]['id'] for u in uploads], fields='size, md5Checksum')
+        mismatched = []
+        for google_file, md5, file_length in uploads:
+            saved_file, error = results[google_file['id']]
+            if error or md5 != saved_file['md5Checksum'] or file_length != int(saved_file['size']):
+                mismatched.append(google_file)
+        return mismatched
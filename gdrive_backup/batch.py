@@ -0,0 +1,69 @@
+import random
+import time
+
+from googleapiclient.http import HttpError
+
+from .rate_limit import call_with_backoff, is_rate_limited
+
+max_batch_size = 100
+
+
+class BatchError(Exception):
+    pass
+
+
+def is_retryable(error):
+    return isinstance(error, HttpError) and (is_rate_limited(error) or error.resp.status >= 500)
+
+
+def execute_batch(drive, requests, batch_size=max_batch_size, retries=5, max_wait=64):
+    """
+    Executes requests in Google Drive batch requests of up to batch_size (100 is the maximum). Requests failing with
+    a rate limit or server error are retried in a later batch with exponential backoff.
+    :param requests: dictionary of key to an unexecuted HttpRequest
+    :return: dictionary of key to (response, error) where error is None if the request succeeded
+    """
+    results = {}
+    pending = list(requests.items())
+    attempt = 0
+    while pending:
+        failed = []
+        for start in range(0, len(pending), batch_size):
+            batch_items = pending[start:start + batch_size]
+
+            def callback(request_id, response, exception, items=batch_items):
+                key, request = items[int(request_id)]
+                if exception is not None and is_retryable(exception) and attempt < retries:
+                    failed.append((key, request))
+                else:
+                    results[key] = (response, exception)
+
+            batch = drive.service.new_batch_http_request(callback=callback)
+            for i, (_key, request) in enumerate(batch_items):
+                batch.add(request, request_id=str(i))
+            call_with_backoff(batch.execute)
+        pending = failed
+        if pending:
+            time.sleep(min(max_wait, 2 ** attempt) + random.random())
+            attempt += 1
+    return results
+
+
+def update_files(drive, file_ids, body):
+    """ Applies the same metadata body to each file id """
+    return execute_batch(drive, {f: drive.service.files().update(fileId=f, body=body, supportsAllDrives=True)
+                                 for f in file_ids})
+
+
+def trash_files(drive, file_ids):
+    return update_files(drive, file_ids, {'trashed': True})
+
+
+def get_files(drive, file_ids, fields='id, size, md5Checksum'):
+    return execute_batch(drive, {f: drive.service.files().get(fileId=f, fields=fields, supportsAllDrives=True)
+                                 for f in file_ids})
+
+
+def failures(results):
+    """ Keys and errors of the requests that failed """
+    return {k: e for k, (_r, e) in results.items() if e is not None}
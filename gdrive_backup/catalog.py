@@ -0,0 +1,53 @@
+from django.conf import settings
+
+from .drive_cache import cached, discard
+from .sql_functions import get_relation_sizes
+
+
+def size_pretty(size):
+    for unit in ['bytes', 'kB', 'MB', 'GB']:
+        if abs(size) < 10240:
+            return f'{size:.0f} {unit}'
+        size /= 1024
+    return f'{size:.0f} TB'
+
+
+class Catalog:
+    """ Sizes of every schema and table read in a single query """
+
+    def __init__(self, relations):
+        """ :param relations: list of (schema, table, size, rows) with a None table for a schema without tables """
+        self.schema_tables = {}
+        for schema, table, size, rows in relations:
+            tables = self.schema_tables.setdefault(schema, [])
+            if table is not None:
+                tables.append((table, size, max(int(rows), 0)))
+
+    def schemas(self):
+        """ :return: list of (schema, total size) ordered by name """
+        return [(s, self.schema_size(s)) for s in sorted(self.schema_tables)]
+
+    def schema_size(self, schema):
+        return sum(t[1] for t in self.schema_tables.get(schema, []))
+
+    def tables(self, schema):
+        """ :return: list of (table, total size, estimated rows) """
+        return self.schema_tables.get(schema, [])
+
+    def largest_first(self, schemas=None):
+        """ Schema names ordered by size so a pool of workers does not start the largest schema last """
+        schemas = self.schema_tables if schemas is None else schemas
+        return sorted(schemas, key=lambda s: -self.schema_size(s))
+
+
+def get_catalog(use_cache=True):
+    """ :param use_cache: False to read the current sizes, otherwise cached for BACKUP_CATALOG_TIMEOUT seconds """
+    if not use_cache:
+        return Catalog(get_relation_sizes())
+    return Catalog(cached('catalog', get_relation_sizes, getattr(settings, 'BACKUP_CATALOG_TIMEOUT', 5 * 60),
+                          versioned=False))
+
+
+def invalidate_catalog():
+    """ Discards the cached sizes after schemas or tables are dropped or restored """
+    discard('catalog')
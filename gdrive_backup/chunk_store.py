@@ -0,0 +1,323 @@
+import calendar
+import datetime
+import hashlib
+import io
+import json
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from googleapiclient.http import HttpError, MediaIoBaseUpload
+
+from .batch import trash_files, failures, BatchError
+from .compression import get_codec
+from .drive_index import list_files
+from .drive_pool import get_drive, get_session, find_create_folder
+from .manifest import ChunkReferences
+from .rate_limit import call_with_backoff
+from .stream_download import get_media
+
+manifest_mime_type = 'application/x-gdrive-backup-manifest'
+chunk_mime_type = 'application/octet-stream'
+chunk_fields = 'nextPageToken, files(id, name, size, appProperties, modifiedTime)'
+drive_time_format = '%Y-%m-%dT%H:%M:%S'
+
+
+class ChunkStoreError(Exception):
+    pass
+
+
+def drive_time(seconds):
+    """ Google Drive RFC 3339 UTC time of a unix timestamp """
+    return datetime.datetime.utcfromtimestamp(seconds).strftime(drive_time_format)
+
+
+def parse_drive_time(value):
+    return calendar.timegm(time.strptime(value[:19], drive_time_format))
+
+
+def content_chunks(stream, average_size=1024 * 1024, min_size=None, max_size=None, read_size=1024 * 1024):
+    """
+    Splits a stream into chunks at boundaries defined by the content so an insertion or deletion only changes the
+    chunks around it. A chunk ends after a line whose crc32 is below a threshold proportional to the length of the
+    line, giving chunks of about average_size whatever the length of the lines. Data without line breaks is cut at
+    max_size.
+    """
+    min_size = average_size // 4 if min_size is None else min_size
+    max_size = average_size * 8 if max_size is None else max_size
+    threshold = (1 << 32) // average_size
+    chunk = bytearray()
+    pending = b''
+    while True:
+        data = stream.read(read_size)
+        if not data:
+            break
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            chunk += line
+            chunk.append(10)
+            if len(chunk) >= max_size or (len(chunk) >= min_size and zlib.crc32(line) < (len(line) + 1) * threshold):
+                yield bytes(chunk)
+                chunk = bytearray()
+        if len(pending) > max_size:
+            chunk += pending
+            pending = b''
+            while len(chunk) >= max_size:
+                yield bytes(chunk[:max_size])
+                del chunk[:max_size]
+    chunk += pending
+    if chunk:
+        yield bytes(chunk)
+
+
+class ChunkStore:
+    """
+    Deduplicated storage of streams in a Google Drive folder. Each distinct chunk is stored once, compressed and
+    named by the sha256 of its contents. A stream is described by a manifest listing its chunks in order.
+    The store is shared by backups running in different threads, a chunk being uploaded by one is waited for by
+    any other backup containing it.
+    The modified time of a chunk records when a backup last used it. A chunk reused more than touch_interval seconds
+    after it was last used is touched so garbage collection keeps it while the backup's manifest is uploaded.
+    """
+
+    def __init__(self, google_credentials, folder_path, codec='bz2', average_size=1024 * 1024, workers=4,
+                 logger=None, references_file=None, touch_interval=6 * 60 * 60):
+        """
+        :param references_file: sqlite file caching the chunks referenced by each manifest for garbage collection
+        :param touch_interval: seconds after which a reused chunk is touched, must be less than the garbage collection
+        grace period minus the length of the longest backup
+        """
+        self.google_credentials = google_credentials
+        self.folder_path = folder_path
+        self.codec = get_codec(codec)
+        self.average_size = average_size
+        self.workers = workers
+        self.logger = logger
+        self.references_file = references_file
+        self.touch_interval = touch_interval
+        self.lock = threading.Lock()
+        self.folder = None
+        self.chunks = None
+        self.used = {}
+
+    @property
+    def drive(self):
+        """ Shared client of the current thread """
+        return get_drive(self.google_credentials)
+
+    @property
+    def session(self):
+        return get_session(self.google_credentials)
+
+    def load(self):
+        """ Lists the chunks already stored the first time the store is used """
+        with self.lock:
+            if self.chunks is None:
+                self.folder = find_create_folder(self.drive, self.folder_path, shared_with_me=True)
+                self.chunks = {}
+                for f in list_files(self.drive, f"'{self.folder['id']}' in parents and trashed = false",
+                                    chunk_fields):
+                    future = Future()
+                    future.set_result((f['id'], int(f['size']), f.get('appProperties', {}).get('codec')))
+                    self.chunks[f['name']] = future
+                    self.used[f['name']] = parse_drive_time(f['modifiedTime'])
+
+    def upload_chunk(self, sha, data):
+        """ Uploads a chunk checking the md5 and size Google Drive stored, a mismatched upload is trashed """
+        compressed = self.codec.compress(data)
+        google_file = call_with_backoff(lambda: self.drive.service.files().create(
+            body={'name': sha, 'parents': [self.folder['id']], 'mimeType': chunk_mime_type,
+                  'appProperties': {'codec': self.codec.name}},
+            media_body=MediaIoBaseUpload(io.BytesIO(compressed), mimetype=chunk_mime_type, resumable=True),
+            fields='id, size, md5Checksum', supportsAllDrives=True).execute())
+        if (google_file.get('md5Checksum') != hashlib.md5(compressed).hexdigest()
+                or int(google_file.get('size', -1)) != len(compressed)):
+            call_with_backoff(self.drive.service.files().update(fileId=google_file['id'], body={'trashed': True},
+                                                                supportsAllDrives=True).execute)
+            raise ChunkStoreError(f'Upload of chunk {sha} does not match, md5 {google_file.get("md5Checksum")} '
+                                  f'size {google_file.get("size")}')
+        return google_file['id'], len(compressed), self.codec.name
+
+    def touch_chunk(self, sha, data, stored):
+        """
+        Sets the modified time of a stored chunk so garbage collection keeps it, uploading it again if it has been
+        trashed or deleted since the store was loaded
+        :param stored: future of the stored chunk
+        """
+        try:
+            google_file = call_with_backoff(self.drive.service.files().update(
+                fileId=stored.result()[0], body={'modifiedTime': drive_time(time.time()) + 'Z'}, fields='trashed',
+                supportsAllDrives=True).execute)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            google_file = {'trashed': True}
+        if google_file.get('trashed'):
+            return self.upload_chunk(sha, data)
+        return stored.result()
+
+    def stale(self, sha):
+        """ Must be called holding the lock """
+        return self.used.get(sha, 0) < time.time() - self.touch_interval
+
+    def chunk_done(self, sha, queued):
+        def callback(future):
+            queued.release()
+            if future.exception():
+                with self.lock:
+                    if self.chunks.get(sha) is future:
+                        del self.chunks[sha]
+        return callback
+
+    def store(self, stream):
+        """
+        Uploads the chunks of stream not already stored
+        :return: manifest dictionary
+        """
+        self.load()
+        entries = []
+        new_chunks = 0
+        new_bytes = 0
+        queued = threading.BoundedSemaphore(self.workers * 2)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for chunk in content_chunks(stream, self.average_size):
+                sha = hashlib.sha256(chunk).hexdigest()
+                with self.lock:
+                    future = self.chunks.get(sha)
+                    submit = future is None or self.stale(sha)
+                if submit:
+                    queued.acquire()
+                    with self.lock:
+                        future = self.chunks.get(sha)
+                        new = future is None
+                        touch = not new and self.stale(sha)
+                        if new:
+                            future = self.chunks[sha] = executor.submit(self.upload_chunk, sha, chunk)
+                        elif touch:
+                            future = self.chunks[sha] = executor.submit(self.touch_chunk, sha, chunk, future)
+                        if new or touch:
+                            self.used[sha] = time.time()
+                    if new or touch:
+                        # Outside the lock as the callback runs immediately if the task has already finished
+                        future.add_done_callback(self.chunk_done(sha, queued))
+                    else:
+                        queued.release()
+                    if new:
+                        new_chunks += 1
+                        new_bytes += len(chunk)
+                entries.append((sha, len(chunk), future))
+        failed = len([e for e in entries if e[2].exception()])
+        if failed:
+            raise ChunkStoreError(f'{failed} chunks failed to upload')
+        manifest = {'size': sum(e[1] for e in entries),
+                    'chunks': [[sha, size] + list(future.result()) for sha, size, future in entries]}
+        if self.logger:
+            self.logger.info(f'{len(entries)} chunks {manifest["size"]} bytes, uploaded {new_chunks} new chunks '
+                             f'{new_bytes} bytes')
+        return manifest
+
+    def get_chunk(self, entry):
+        sha, size, chunk_id, _stored_size, codec = entry
+        data = get_codec(codec or self.codec.name).decompress(get_media(self.session, chunk_id))
+        if hashlib.sha256(data).hexdigest() != sha:
+            raise ChunkStoreError(f'Chunk {sha} is corrupt')
+        return data
+
+    def read(self, manifest, read_ahead=4):
+        return ChunkReader(self, manifest, read_ahead)
+
+    def referenced_chunks(self):
+        """
+        Chunk ids in every manifest including those in the trash which could still be restored.
+        New manifests are downloaded and cached in references_file.
+        """
+        references = ChunkReferences(self.references_file) if self.references_file else None
+        try:
+            cached = references.get_all() if references else {}
+            referenced = set()
+            manifest_ids = set()
+            for f in list_files(self.drive, f"mimeType = '{manifest_mime_type}'", 'nextPageToken, files(id)'):
+                manifest_ids.add(f['id'])
+                chunk_ids = cached.get(f['id'])
+                if chunk_ids is None:
+                    manifest = json.loads(get_media(self.session, f['id']))
+                    chunk_ids = [c[2] for c in manifest['chunks']]
+                    if references:
+                        references.set(f['id'], chunk_ids)
+                referenced.update(chunk_ids)
+            for manifest_id in set(cached) - manifest_ids:
+                references.delete(manifest_id)
+        finally:
+            if references:
+                references.close()
+        return referenced
+
+    def collect_garbage(self, grace=24 * 60 * 60):
+        """
+        Trashes chunks no manifest refers to. Chunks uploaded or used within grace seconds are kept as they may belong
+        to a backup whose manifest has not been uploaded yet. A backup in another process that touches a chunk after
+        it is listed here can still reference it once trashed, it stays readable from the trash and the next backup
+        uploads it again.
+        """
+        self.load()
+        referenced = self.referenced_chunks()
+        cutoff = time.time() - grace
+        with self.lock:
+            used = {sha for sha, last_used in self.used.items() if last_used >= cutoff}
+        query = f"'{self.folder['id']}' in parents and trashed = false and modifiedTime < '{drive_time(cutoff)}'"
+        unreferenced = {f['id']: f['name'] for f in list_files(self.drive, query, chunk_fields)
+                        if f['id'] not in referenced and f['name'] not in used}
+        failed = failures(trash_files(self.drive, unreferenced))
+        with self.lock:
+            for chunk_id, name in unreferenced.items():
+                if chunk_id not in failed:
+                    self.chunks.pop(name, None)
+        removed = len(unreferenced) - len(failed)
+        if self.logger:
+            self.logger.info(f'Removed {removed} unreferenced chunks{f", {len(failed)} failed" if failed else ""}')
+        if failed:
+            raise BatchError(f'{len(failed)} unreferenced chunks could not be trashed')
+        return removed
+
+
+class ChunkReader(io.RawIOBase):
+    """ Readable stream reassembled from a manifest downloading read_ahead chunks ahead of the reader """
+
+    def __init__(self, store, manifest, read_ahead=4):
+        self.store = store
+        self.entries = deque(manifest['chunks'])
+        self.read_ahead = read_ahead
+        self.executor = ThreadPoolExecutor(max_workers=read_ahead)
+        self.pending = deque()
+        self.buffer = b''
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size < 0:
+            return self.readall()
+        while self.position >= len(self.buffer) and (self.entries or self.pending):
+            while self.entries and len(self.pending) < self.read_ahead:
+                self.pending.append(self.executor.submit(self.store.get_chunk, self.entries.popleft()))
+            self.buffer = self.pending.popleft().result()
+            self.position = 0
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        for f in self.pending:
+            f.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
+        super().close()
@@ -1,36 +1,296 @@
+import abc
+import io
 import os
 import bz2
-import subprocess
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from shutil import copyfileobj
 
+from .progress import CountingStream
 
-def decompress(filename):
+try:
+    import zstandard
+except ImportError:
+    # Allow for not using zstd and not installing zstandard
+    zstandard = None
+
+
+class Codec(abc.ABC):
+    """
+    Compression backend. Compressors and decompressors follow the bz2/zlib incremental interface of
+    compress/flush and decompress/eof/unused_data.
+    """
+    name = None
+    extension = None
+    mime_type = None
+    default_level = None
+
+    def __init__(self, level=None, workers=1, block_size=4*1024*1024):
+        self.level = self.default_level if level is None else level
+        self.workers = workers
+        self.block_size = block_size
+
+    @abc.abstractmethod
+    def new_compressor(self):
+        """ Compressor of a single independent stream """
+
+    @abc.abstractmethod
+    def new_decompressor(self):
+        """ Decompressor of a single stream """
+
+    def compress(self, data):
+        """ Compresses data as a single independent stream """
+        compressor = self.new_compressor()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        return self.decompressor().decompress(data)
+
+    def compressor(self):
+        if self.workers > 1:
+            return ParallelCompressor(self, self.workers, self.block_size)
+        return self.new_compressor()
+
+    def decompressor(self):
+        return MultiStreamDecompressor(self.new_decompressor)
+
+
+class Bz2Codec(Codec):
+    """ With workers the output is concatenated bz2 streams in the same way as pbzip2 """
+    name = 'bz2'
+    extension = 'bz2'
+    mime_type = 'application/x-bzip2'
+    default_level = 9
+
+    def new_compressor(self):
+        return bz2.BZ2Compressor(self.level)
+
+    def new_decompressor(self):
+        return bz2.BZ2Decompressor()
+
+
+class GzipCodec(Codec):
+    """ With workers the output is concatenated gzip members which gunzip reads as one file """
+    name = 'gz'
+    extension = 'gz'
+    mime_type = 'application/x-gzip'
+    default_level = 6
+
+    def new_compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def new_decompressor(self):
+        return zlib.decompressobj(31)
+
+
+class ZstdCodec(Codec):
+    """ zstd uses its own worker threads so is not split into blocks """
+    name = 'zstd'
+    extension = 'zst'
+    mime_type = 'application/x-zstd'
+    default_level = 3
+
+    def __init__(self, *args, **kwargs):
+        if zstandard is None:
+            raise ImportError('zstandard must be installed to use zstd compression')
+        super().__init__(*args, **kwargs)
+
+    def new_compressor(self):
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=self.level, threads=self.workers if self.workers > 1 else 0
+                                        ).compressobj()
+
+    def new_decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+codecs = {}
+
+
+def register_codec(codec_class):
+    codecs[codec_class.name] = codec_class
+    return codec_class
+
+
+for _codec in [Bz2Codec, GzipCodec, ZstdCodec]:
+    register_codec(_codec)
+
+mime_types = {c.extension: c.mime_type for c in codecs.values()}
+
+
+def get_codec(codec='bz2', level=None, workers=1, **kwargs):
+    """
+    :param codec: Codec instance or registered name. Parameters can be taken directly from BACKUP_COMPRESSION
+    """
+    if isinstance(codec, Codec):
+        return codec
+    if codec not in codecs:
+        raise ValueError('Unknown compression type: ' + codec)
+    return codecs[codec](level=level, workers=workers, **kwargs)
+
+
+def get_extension_codec(filename):
     extension = filename[filename.rfind('.') + 1:].lower()
-    decompressed_name = filename[:- 1 * (len(extension) + 1)]
+    for c in codecs.values():
+        if c.extension == extension:
+            return c
+    raise ValueError('Unknown file type: ' + filename)
 
-    if extension == 'bz2':
-        with bz2.BZ2File(filename, 'rb') as input_file:
-            with open(decompressed_name, 'wb') as output:
-                copyfileobj(input_file, output)
-        os.remove(filename)
 
-    elif extension == 'gz':
-        subprocess.call(['gunzip', filename])
+class ParallelCompressor:
+    """
+    Compresses fixed size blocks on a thread pool, each as an independent stream, returning them in order.
+    bz2, zlib and zstd release the GIL while compressing. At most 2 blocks per worker are held in memory.
+    """
 
-    else:
-        raise ValueError('Unknown file type: ' + filename)
+    def __init__(self, codec, workers, block_size):
+        self.codec = codec
+        self.block_size = block_size
+        self.max_pending = workers * 2
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.blocks = 0
 
-    return decompressed_name
+    def compress_block(self, block):
+        return self.codec.compress(block)
+
+    def submit(self, block):
+        self.pending.append(self.executor.submit(self.compress_block, block))
+        self.blocks += 1
+
+    def compress(self, data):
+        try:
+            self.buffer += data
+            while len(self.buffer) >= self.block_size:
+                self.submit(bytes(self.buffer[:self.block_size]))
+                del self.buffer[:self.block_size]
+            output = []
+            while self.pending and (self.pending[0].done() or len(self.pending) > self.max_pending):
+                output.append(self.pending.popleft().result())
+            return b''.join(output)
+        except BaseException:
+            self.close()
+            raise
+
+    def flush(self):
+        try:
+            if self.buffer or self.blocks == 0:
+                self.submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            output = [f.result() for f in self.pending]
+        finally:
+            self.close()
+        return b''.join(output)
+
+    def close(self):
+        """ Drops blocks not yet compressed and stops the workers, called when compression fails or is abandoned """
+        for f in self.pending:
+            f.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
+
+
+class MultiStreamDecompressor:
+    """ Decompresses concatenated streams as produced by ParallelCompressor, pbzip2 or pigz """
 
+    def __init__(self, new_decompressor):
+        self.new_decompressor = new_decompressor
+        self.decompressor = new_decompressor()
+        # Data has been passed to the current decompressor
+        self.started = False
 
-def compress(filename, compression_type):
-    if compression_type == 'bz2':
+    def decompress(self, data):
+        output = []
+        while data:
+            self.started = True
+            output.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            data = self.decompressor.unused_data
+            self.decompressor = self.new_decompressor()
+            self.started = False
+        return b''.join(output)
+
+    def flush(self):
+        """ Called at the end of the input, raises EOFError if it ended part way through a stream """
+        if self.started and not self.decompressor.eof:
+            raise EOFError('Compressed data ended before the end of the stream')
+        return b''
+
+
+def decompress(filename):
+    codec = get_extension_codec(filename)
+    decompressed_name = filename[:- 1 * (len(codec.extension) + 1)]
+    try:
         with open(filename, 'rb') as input_file:
-            with bz2.BZ2File(filename + '.' + compression_type, 'wb', compresslevel=9) as output:
-                copyfileobj(input_file, output, 1024*1024)
-        os.remove(filename)
+            with open(decompressed_name, 'wb') as output:
+                copyfileobj(CompressedStream(input_file, codec(), decompress=True), output, 1024*1024)
+    except BaseException:
+        # Keep the compressed file and remove the incomplete output of a truncated or corrupt file
+        if os.path.exists(decompressed_name):
+            os.remove(decompressed_name)
+        raise
+    os.remove(filename)
+    return decompressed_name
+
+
+def compress(filename, compression_type, progress=None):
+    """ :param progress: called with the number of bytes read from filename as they are compressed """
+    codec = get_codec(compression_type)
+    with open(filename, 'rb') as input_file:
+        source = CountingStream(input_file, progress) if progress else input_file
+        with open(filename + '.' + codec.extension, 'wb') as output:
+            copyfileobj(CompressedStream(source, codec), output, 1024*1024)
+    os.remove(filename)
+    return filename + '.' + codec.extension
+
+
+class CompressedStream(io.RawIOBase):
+    """
+    Readable stream of compressed (or decompressed) data produced incrementally from a source stream.
+    Only the data needed to satisfy each read is held in memory.
+    """
+
+    def __init__(self, source, compression_type, block_size=1024*1024, decompress=False):
+        self.source = source
+        codec = get_codec(compression_type)
+        self.processor = codec.decompressor() if decompress else codec.compressor()
+        self.process = self.processor.decompress if decompress else self.processor.compress
+        self.finish = self.processor.flush
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if not self.closed and not self.finished and hasattr(self.processor, 'close'):
+            self.processor.close()
+        super().close()
+
+    def _fill(self, size):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            data = self.source.read(self.block_size)
+            if data:
+                self.buffer += self.process(data)
+            else:
+                self.buffer += self.finish()
+                self.finished = True
 
-    elif compression_type == 'gz':
-        subprocess.call(['gzip', filename])
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
 
-    return filename + '.' + compression_type
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.core.cache import caches
+
+version_key = 'gdrive_backup:version'
+
+
+def get_cache():
+    return caches[getattr(settings, 'BACKUP_CACHE', 'default')]
+
+
+def cache_version():
+    return get_cache().get_or_set(version_key, 1, None)
+
+
+def cached(key, function, timeout=None, versioned=True):
+    """
+    Returns the cached value of key or calls function to set it.
+    Versioned values (file listings and quota) are all discarded by invalidate.
+    :param timeout: seconds defaulting to BACKUP_CACHE_TIMEOUT
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'BACKUP_CACHE_TIMEOUT', 5 * 60)
+    cache = get_cache()
+    key = f'gdrive_backup:{key}'
+    version = cache_version() if versioned else None
+    value = cache.get(key, version=version)
+    if value is None:
+        value = function()
+        cache.set(key, value, timeout, version=version)
+    return value
+
+
+def discard(key):
+    """ Removes an unversioned value set by cached """
+    get_cache().delete(f'gdrive_backup:{key}')
+
+
+def invalidate():
+    """ Discards cached file listings and quota after files are backed up, pruned, undeleted or removed """
+    cache = get_cache()
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        cache.set(version_key, 2, None)
@@ -0,0 +1,125 @@
+import threading
+
+from google_client.drive import folder_type
+
+from .rate_limit import call_with_backoff
+
+index_fields = 'nextPageToken, files(id, name, parents, mimeType, md5Checksum, appProperties, size)'
+
+
+def list_files(drive, q, fields=index_fields, page_size=1000):
+    """ Yields every file matching the query a page at a time retrying rate limit errors """
+    kwargs = dict(q=q, fields=fields, pageSize=page_size, supportsAllDrives=True, includeItemsFromAllDrives=True)
+    if drive.shared_drive:
+        kwargs.update(dict(corpora='drive', driveId=drive.shared_drive))
+    page_token = None
+    while True:
+        results = call_with_backoff(drive.service.files().list(**kwargs, pageToken=page_token).execute)
+        yield from results.get('files', [])
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+
+class DriveTreeIndex:
+    """
+    In memory index of every folder and file below a Google Drive folder. The tree is loaded a level at a time
+    listing the children of many folders in each query so a large tree needs tens of requests rather than one
+    or two per folder. Paths are relative to the root folder separated by / with '' as the root.
+    """
+
+    def __init__(self, drive, root_folder, parents_per_query=50, page_size=1000):
+        """
+        :param root_folder: Folder dictionary or a callable returning it which is called when the index is first used
+        """
+        self.drive = drive
+        self.root_folder = root_folder
+        self.parents_per_query = parents_per_query
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.folders = None
+        self.files = None
+        self.children = None
+
+    def list_children(self, folder_ids):
+        parents = ' or '.join([f"'{f}' in parents" for f in folder_ids])
+        return list_files(self.drive, f'({parents}) and trashed = false', index_fields, self.page_size)
+
+    def load(self):
+        if callable(self.root_folder):
+            self.root_folder = self.root_folder()
+        folders = {'': self.root_folder}
+        files = {'': []}
+        children = {'': []}
+        paths = {self.root_folder['id']: ''}
+        level = [self.root_folder['id']]
+        while level:
+            next_level = []
+            for i in range(0, len(level), self.parents_per_query):
+                for f in self.list_children(level[i:i + self.parents_per_query]):
+                    parent_path = next(paths[p] for p in f['parents'] if p in paths)
+                    path = f'{parent_path}/{f["name"]}' if parent_path else f['name']
+                    if f['mimeType'] == folder_type:
+                        if path not in folders:
+                            folders[path] = f
+                            files[path] = []
+                            children[path] = []
+                            children[parent_path].append(path)
+                            paths[f['id']] = path
+                            next_level.append(f['id'])
+                    else:
+                        files[parent_path].append(f)
+            level = next_level
+        self.folders = folders
+        self.files = files
+        self.children = children
+
+    @property
+    def loaded(self):
+        return self.folders is not None
+
+    def ensure_loaded(self):
+        with self.lock:
+            if self.folders is None:
+                self.load()
+
+    def folder(self, path):
+        self.ensure_loaded()
+        return self.folders.get(path.strip('/'))
+
+    def find_create_folder(self, path):
+        path = path.strip('/')
+        self.ensure_loaded()
+        with self.lock:
+            if path in self.folders:
+                return self.folders[path]
+            parent_path = path[:path.rfind('/')] if '/' in path else ''
+        parent = self.find_create_folder(parent_path)
+        with self.lock:
+            if path not in self.folders:
+                folder = call_with_backoff(self.drive.create_folder, path.split('/')[-1], parent)
+                self.folders[path] = dict(folder, name=path.split('/')[-1], mimeType=folder_type,
+                                          parents=[parent['id']])
+                self.files[path] = []
+                self.children[path] = []
+                self.children[parent_path].append(path)
+            return self.folders[path]
+
+    def sub_folders(self, path):
+        self.ensure_loaded()
+        return list(self.children.get(path.strip('/'), []))
+
+    def files_in(self, path):
+        self.ensure_loaded()
+        return self.files.get(path.strip('/'), [])
+
+    def file_hashes(self, path, get_hash=lambda f: f.get('md5Checksum')):
+        file_hashes = {}
+        for f in self.files_in(path):
+            file_hashes.setdefault(f['name'], []).append(get_hash(f))
+        return file_hashes
+
+    def add_file(self, path, google_file):
+        self.ensure_loaded()
+        with self.lock:
+            self.files.setdefault(path.strip('/'), []).append(google_file)
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import threading
+from contextlib import contextmanager
+
+from google.auth.transport.requests import AuthorizedSession
+from google.oauth2 import service_account
+from google_client.drive import GoogleDrive
+from googleapiclient import discovery
+from googleapiclient.http import HttpError
+
+try:
+    from googleapiclient.discovery_cache import get_static_doc
+except ImportError:
+    # Older google-api-python-client without bundled discovery documents
+    get_static_doc = None
+
+lock = threading.Lock()
+shared_credentials = {}
+shared_documents = {}
+folders = {}
+local = threading.local()
+
+
+def credentials_key(google_credentials):
+    return hashlib.sha256(google_credentials.encode()).hexdigest()
+
+
+class PooledDrive(GoogleDrive):
+    """
+    GoogleDrive sharing the service account credentials, and so the access token, of every client for the same key
+    and built from a discovery document parsed once per process
+    """
+
+    def __init__(self, google_credentials, **kwargs):
+        self.pool_key = credentials_key(google_credentials)
+        super().__init__(google_credentials, **kwargs)
+
+    def create_folder(self, title, parent):
+        with parent_check(parent):
+            return super().create_folder(title, parent)
+
+    def create_file_stream(self, title, parent, data_stream, body=None, mime_type=None):
+        with parent_check(parent):
+            return super().create_file_stream(title, parent, data_stream, body=body, mime_type=mime_type)
+
+    def get_service_account(self):
+        self.credentials = get_credentials(self.credentials, self.scopes)
+        document = get_document(self.api_name, self.api_version)
+        if document is None:
+            return discovery.build(self.api_name, self.api_version, credentials=self.credentials,
+                                   cache_discovery=False)
+        return discovery.build_from_document(document, credentials=self.credentials)
+
+
+def get_credentials(google_credentials, scopes):
+    """ Service account credentials shared by the process, the token is refreshed by google-auth when it expires """
+    key = credentials_key(google_credentials)
+    with lock:
+        if key not in shared_credentials:
+            shared_credentials[key] = service_account.Credentials.from_service_account_info(
+                json.loads(google_credentials), scopes=scopes)
+        return shared_credentials[key]
+
+
+def get_document(api_name, api_version):
+    if get_static_doc is None:
+        return None
+    with lock:
+        if (api_name, api_version) not in shared_documents:
+            document = get_static_doc(api_name, api_version)
+            shared_documents[(api_name, api_version)] = json.loads(document) if document else None
+        return shared_documents[(api_name, api_version)]
+
+
+def get_drive(google_credentials):
+    """
+    GoogleDrive client for google_credentials reused by everything running in the current thread. Clients are not
+    shared between threads as their http connection is not thread safe, but keep it alive between requests.
+    """
+    if not hasattr(local, 'drives'):
+        local.drives = {}
+    key = credentials_key(google_credentials)
+    if key not in local.drives:
+        local.drives[key] = PooledDrive(google_credentials)
+    return local.drives[key]
+
+
+def get_session(google_credentials):
+    """ AuthorizedSession for google_credentials reused by the current thread """
+    if not hasattr(local, 'sessions'):
+        local.sessions = {}
+    key = credentials_key(google_credentials)
+    if key not in local.sessions:
+        local.sessions[key] = AuthorizedSession(get_drive(google_credentials).credentials)
+    return local.sessions[key]
+
+
+def forget_folder(folder_id):
+    """ Drops a cached folder, and the folders found inside it, so the next lookup finds or creates it again """
+    with lock:
+        for key in [k for k, f in folders.items() if folder_id in (f['id'], k[3])]:
+            del folders[key]
+
+
+@contextmanager
+def parent_check(parent):
+    """ Forgets the cached parent folder when Google Drive responds that it does not exist """
+    try:
+        yield
+    except HttpError as e:
+        if parent and e.resp.status == 404:
+            forget_folder(parent['id'])
+        raise
+
+
+def find_create_folder(drive, path, shared_with_me=False, folder=None):
+    """
+    Folder dictionary for path found or created once per process for each service account. A cached folder is used
+    without a request, it is dropped when creating something inside it fails with a 404 and looked up again next time.
+    """
+    key = (getattr(drive, 'pool_key', id(drive)), path, shared_with_me, folder['id'] if folder else None)
+    with lock:
+        google_folder = folders.get(key)
+    if google_folder:
+        return google_folder
+    kwargs = {'folder': folder} if folder else {}
+    google_folder = drive.find_create_folder(path, shared_with_me=shared_with_me, **kwargs)
+    with lock:
+        folders[key] = google_folder
+    return google_folder
@@ -1,11 +1,10 @@
-import base64
-import datetime
 import json
-from io import BytesIO
 
 from ajax_helpers.mixins import AjaxHelpers, AjaxTaskMixin
 from django.conf import settings
 from django.contrib.auth.mixins import PermissionRequiredMixin
+from django.urls import reverse
+from django.views import View
 from django_datatables.columns import DateTimeColumn, DatatableColumn, ColumnLink, ColumnBase
 from django_datatables.datatables import DatatableView
 from django_datatables.helpers import row_button, overwrite_cell
@@ -13,10 +12,14 @@ from django_menus.menu import MenuMixin
 from django_modals.datatables import ModalLink
 from django_modals.decorators import ConfirmAjaxMethod
 from django_modals.helper import reverse_modal
-from openpyxl import Workbook
 
 from gdrive_backup.backup import Backup
-from .sql_functions import get_schemas, get_schema_tables, get_table_column_names, get_table_data
+from .batch import update_files, failures
+from .drive_cache import invalidate
+from .catalog import get_catalog, size_pretty
+from .models import BackupRun
+from .run_history import stage_order
+from .table_export import export_response, stored_export_response
 from .tasks import ajax_backup
 
 
@@ -80,6 +83,7 @@ class BackupView(TableBackup,  PermissionRequiredMixin,  MenuMixin, DatatableVie
                  {'visible': len(self.schemas) > 1}),
                 (f'gdrive_backup:schema_info,{self.schemas[0][0]}', f'View {self.schemas[0][0]}',
                  {'visible': len(self.schemas) == 1}),
+                ('gdrive_backup:backup_runs', 'Run History'),
                 ('gdrive_backup:confirm_empty_trash', 'Empty Trash', {'css_classes': 'btn btn-warning'}),
                 ('gdrive_backup:confirm_drop_schema,-', 'Drop Public Schema',
                  {'css_classes': 'btn btn-danger', 'visible': getattr(settings, 'DEBUG', False)}),
@@ -88,7 +92,7 @@ class BackupView(TableBackup,  PermissionRequiredMixin,  MenuMixin, DatatableVie
     # noinspection PyAttributeOutsideInit
     def dispatch(self, request, *args, schema=None, **kwargs):
         self.schema = schema
-        self.schemas = get_schemas()
+        self.schemas = get_catalog().schemas()
         return super().dispatch(request, *args, **kwargs)
 
     def add_tables(self):
@@ -99,7 +103,7 @@ class BackupView(TableBackup,  PermissionRequiredMixin,  MenuMixin, DatatableVie
 
     @staticmethod
     def setup_files(table):
-        table.add_columns('.id', 'ip_address', 'table', 'name', 'size',
+        table.add_columns('.id', 'ip_address', 'table', 'name', 'size', 'format',
                           DateTimeColumn(title='Backup Date', field='createdTime'),
                           DatatableColumn(column_name='drop_restore',
                                           render=[row_button('drop_restore', 'Drop Restore',
@@ -126,7 +130,10 @@ class BackupView(TableBackup,  PermissionRequiredMixin,  MenuMixin, DatatableVie
 
     def row_undelete(self, row_no, **_kwargs):
         db = Backup().get_backup_db()
-        db.drive.service.files().update(fileId=row_no[1:], body={'trashed': False}).execute()
+        failed = failures(update_files(db.drive, [row_no[1:]], {'trashed': False}))
+        if failed:
+            return self.command_response('message', text=f'Could not undelete backup {list(failed.values())[0]}')
+        invalidate()
         return self.command_response('reload')
 
     def setup_schemas(self, table):
@@ -139,7 +146,7 @@ class BackupView(TableBackup,  PermissionRequiredMixin,  MenuMixin, DatatableVie
             ColumnBase(column_name='Backup',
                        render=[row_button('backup_schema', 'Backup', button_classes='btn btn-success btn-sm',)])
         )
-        table.table_data = [{'schema': s[0], 'size': s[1]} for s in self.schemas]
+        table.table_data = [{'schema': s[0], 'size': size_pretty(s[1])} for s in self.schemas]
         table.table_options['column_id'] = 0
         table.sort('schema')
         table.table_options['stateSave'] = False
@@ -154,20 +161,20 @@ class BackupView(TableBackup,  PermissionRequiredMixin,  MenuMixin, DatatableVie
         db = Backup().get_backup_db(schema=self.schema)
         meta = db.base_backup_dir
         folder_button = '<a target="_blank" href="{}">{}</a>'.format(meta['webViewLink'], meta['name'])
-        about = db.drive.service.about().get(fields='*').execute()
+        quota = db.storage_quota()
         return self.command_response(
             'html',
             selector='#storage_info',
             html="Google Drive Folder {}<br>{:.1f} GB Used of {:.1f} GB".format(
                 folder_button,
-                int(about['storageQuota']['usage']) / (1024*1024*1024),
-                int(about['storageQuota']['limit']) / (1024*1024*1024)
+                int(quota['usage']) / (1024*1024*1024),
+                int(quota['limit']) / (1024*1024*1024)
             )
         )
 
     def get_table_query(self, table, **kwargs):
-        trashed = {} if table.table_id == 'files' else {'trashed': True}
-        files = Backup().get_backup_db(schema=self.schema).get_db_backup_files(**trashed)
+        db = Backup().get_backup_db(schema=self.schema)
+        files = db.cached_db_backup_files(trashed=table.table_id != 'files')
         return [dict(**f, **f.get('appProperties', {})) for f in files if not f.get('appProperties', {}).get('table')]
 
 
@@ -195,34 +202,93 @@ class SchemaTableView(TableBackup, AjaxTaskMixin, PermissionRequiredMixin, AjaxH
         table.sort('-createdTime')
         table.table_options['stateSave'] = False
 
+    def download(self, table_name, export_format):
+        return self.command_response('redirect', url=reverse('gdrive_backup:export_table', args=[
+            self.kwargs['schema'], table_name, export_format]))
+
     def row_download_xls(self,  **kwargs):
-        workbook = Workbook()
-        sheet = workbook.active
-        sheet.append(get_table_column_names(self.kwargs['schema'], table_name=kwargs['row_no'][1:]))
-        for r in get_table_data(self.kwargs['schema'], table_name=kwargs['row_no'][1:]):
-            sheet.append([c.replace(tzinfo=None) if isinstance(c, datetime.datetime) else c for c in r])
-        output = BytesIO()
-        workbook.save(output)
-        output.seek(0)
-        filename = f'{kwargs["row_no"][1:]}.xlsx'
-        return self.command_response('save_file', data=base64.b64encode(output.read()).decode('ascii'),
-                                     filename=filename)
+        return self.command_response('show_modal', modal=reverse_modal(
+            'gdrive_backup:export_xlsx', base64={'schema': self.kwargs['schema'], 'table': kwargs['row_no'][1:]}))
+
+    def row_download_csv(self,  **kwargs):
+        return self.download(kwargs['row_no'][1:], 'csv')
 
     def setup_schema_tables(self, table):
         table.add_columns(
             'table', 'size', ('rows', {'title': 'No. Rows (Approx)'}),
             ColumnBase(column_name='Download',
                        render=[row_button('download_xls', '<i class="far fa-file-excel"></i>',
+                                          button_classes='btn btn-outline-secondary btn-sm', ),
+                               row_button('download_csv', '<i class="fas fa-file-csv"></i>',
                                           button_classes='btn btn-outline-secondary btn-sm', )]),
             ColumnBase(column_name='Backup',
                        render=[row_button('backup_schema', 'Backup', button_classes='btn btn-success btn-sm', )])
         )
-        table.table_data = [{'table': s[0], 'size': s[1], 'rows': s[2]}
-                            for s in get_schema_tables(self.kwargs['schema'])]
+        table.table_data = [{'table': s[0], 'size': size_pretty(s[1]), 'rows': s[2]}
+                            for s in get_catalog().tables(self.kwargs['schema'])]
         table.table_options['column_id'] = 0
         table.sort('table')
         table.table_options['stateSave'] = False
 
     def get_table_query(self, table, **kwargs):
-        files = Backup().get_backup_db(schema=self.kwargs.get('schema')).get_db_backup_files()
+        files = Backup().get_backup_db(schema=self.kwargs.get('schema')).cached_db_backup_files()
         return [dict(**f, **f['appProperties']) for f in files if f.get('appProperties', {}).get('table')]
+
+
+class TableExportView(PermissionRequiredMixin, View):
+    """ Streams a table as a csv download """
+    permission_required = 'access_admin'
+
+    def get(self, request, *args, schema=None, table=None, export_format=None, **kwargs):
+        return export_response(schema, table, export_format)
+
+
+class ExportDownloadView(PermissionRequiredMixin, View):
+    """ Download of an xlsx built by the export task """
+    permission_required = 'access_admin'
+
+    def get(self, request, *args, key=None, filename=None, **kwargs):
+        return stored_export_response(key, filename)
+
+
+class BackupRunView(PermissionRequiredMixin, MenuMixin, DatatableView):
+    """ Duration, sizes and stage times of recent backup runs """
+    template_name = 'gdrive_backup/runs.html'
+    permission_required = 'access_admin'
+    max_runs = 500
+
+    def setup_menu(self):
+        self.add_menu('breadcrumbs', menu_type='breadcrumb').add_items(
+            ('gdrive_backup:backup_info', 'backup'),
+            ('gdrive_backup:backup_runs', 'runs'),
+        )
+
+    def add_tables(self):
+        self.add_table('runs')
+
+    @staticmethod
+    def run_row(run):
+        stages = list(run.stages.all())
+        row = {'id': run.id, 'started': f'{run.started:%Y-%m-%d %H:%M}', 'status': run.status, 'host': run.host,
+               'backup': 'all schemas' if run.all_schemas else '.'.join(p for p in (run.schema, run.table) if p),
+               'seconds': f'{run.seconds:.0f}' if run.seconds is not None else '',
+               'dump_size': size_pretty(sum(s.bytes or 0 for s in stages if s.name == 'dump')),
+               'upload_size': size_pretty(sum(s.bytes or 0 for s in stages if s.name == 'upload')),
+               'ratio': f'{run.compression_ratio:.1f}' if run.compression_ratio else '',
+               'error': run.error}
+        for name in stage_order:
+            # Stages of concurrent schema backups overlap so their total can exceed the run time
+            row[name] = f'{sum(s.seconds for s in stages if s.name == name):.0f}' if any(
+                s.name == name for s in stages) else ''
+        return row
+
+    def setup_runs(self, table):
+        table.add_columns('.id', 'started', 'status', 'host', 'backup', ('seconds', {'title': 'Seconds'}),
+                          ('dump_size', {'title': 'Dumped'}), ('upload_size', {'title': 'Uploaded'}),
+                          ('ratio', {'title': 'Compression'}),
+                          *[(name, {'title': f'{name.replace("_", " ").capitalize()} s'}) for name in stage_order],
+                          'error')
+        runs = BackupRun.objects.prefetch_related('stages')[:self.max_runs]
+        table.table_data = [self.run_row(r) for r in runs]
+        table.sort('-started')
+        table.table_options['stateSave'] = False
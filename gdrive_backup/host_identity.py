@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+
+import requests
+
+# appProperty of each database backup identifying the host it was taken on
+host_key = 'ip_address'
+lookup_url = 'https://api.ipify.org/'
+
+lock = threading.Lock()
+resolved = {}
+
+
+def lookup_ip_address(timeout=5):
+    """ Public ip address with _ in place of . or None if it is not returned within timeout seconds """
+    try:
+        response = requests.get(lookup_url, timeout=timeout)
+    except requests.exceptions.RequestException:
+        return None
+    if response.status_code == 200 and len(response.text) < 16:
+        return response.text.replace('.', '_')
+
+
+def read_host_id(state_file):
+    try:
+        with open(state_file) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def write_host_id(state_file, host_id):
+    try:
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+        with open(state_file + '.tmp', 'w') as f:
+            f.write(host_id)
+        os.replace(state_file + '.tmp', state_file)
+    except OSError:
+        pass
+
+
+def get_host_id(host_id=None, state_file=None, timeout=5, retry_interval=10 * 60):
+    """
+    Identity of this host stored in the backups it takes and used to select the backups it prunes.
+    host_id is used if set, otherwise the public ip address is looked up once per process. The last address found
+    is saved in state_file and used when the lookup fails, a failed lookup is tried again after retry_interval
+    seconds.
+    """
+    if host_id:
+        return host_id
+    with lock:
+        cached = resolved.get(state_file)
+        if cached and (cached[1] or time.time() - cached[2] < retry_interval):
+            return cached[0]
+        ip_address = lookup_ip_address(timeout)
+        if ip_address:
+            if state_file and read_host_id(state_file) != ip_address:
+                write_host_id(state_file, ip_address)
+            resolved[state_file] = (ip_address, True, time.time())
+        else:
+            fallback = (read_host_id(state_file) if state_file else None) or 'exception'
+            resolved[state_file] = (fallback, False, time.time())
+        return resolved[state_file][0]
+
+
+def host_query(host_id):
+    """ Google Drive query term matching the backups of host_id """
+    return f"appProperties has {{ key='{host_key}' and value='{host_id}'}}"
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...backup import Backup
+
+
+class Logger:
+    @staticmethod
+    def info(text):
+        print(text)
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('--schema',
+                            nargs='?',
+                            help='Specifies which schema to prune')
+
+        parser.add_argument('--all_schemas',
+                            action='store_true',
+                            default=False)
+
+        parser.add_argument('--dry_run',
+                            action='store_true',
+                            default=False,
+                            help='List the backups that would be removed')
+
+    def handle(self, *args, **options):
+        backup = Backup(logger=Logger())
+        if options['all_schemas']:
+            removed = backup.prune_schemas(dry_run=options['dry_run'])
+        else:
+            removed = backup.get_backup_db(schema=options['schema']).prune_old_backups(settings.BACKUP_DB_RETENTION,
+                                                                                       dry_run=options['dry_run'])
+        print(f'{len(removed)} backups {"to remove" if options["dry_run"] else "removed"}')
@@ -0,0 +1,117 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class SqliteStore:
+    """ Thread safe sqlite file committing every commit_interval writes and on close """
+    create_sql = None
+
+    def __init__(self, filename, commit_interval=500):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute(self.create_sql)
+        self.lock = threading.Lock()
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+
+    def fetch(self, sql, parameters):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def write(self, sql, parameters):
+        with self.lock:
+            self.connection.execute(sql, parameters)
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_interval:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+class FileManifest(SqliteStore):
+    """
+    Persistent record of local files already backed up, keyed by destination and path. A file whose size,
+    mtime_ns and inode are unchanged is not hashed again and its Google Drive folder is not listed.
+    Delete the manifest file to force every file to be checked against Google Drive.
+    """
+    create_sql = ('CREATE TABLE IF NOT EXISTS files (destination TEXT, path TEXT, size INTEGER, mtime_ns INTEGER, '
+                  'inode INTEGER, md5 TEXT, drive_id TEXT, PRIMARY KEY (destination, path))')
+
+    @staticmethod
+    def stat_key(stat):
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def get(self, destination, path):
+        rows = self.fetch('SELECT size, mtime_ns, inode, md5, drive_id FROM files WHERE destination = ? AND path = ?',
+                          (destination, path))
+        return rows[0] if rows else None
+
+    def unchanged(self, record, stat):
+        return record is not None and tuple(record[:3]) == self.stat_key(stat)
+
+    def set(self, destination, path, stat, md5, drive_id):
+        self.write('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (destination, path) + self.stat_key(stat) + (md5, drive_id))
+
+
+class S3Checkpoint(SqliteStore):
+    """
+    Persistent record of the S3 objects copied to a Google Drive destination. Objects with an unchanged ETag are
+    skipped without listing Google Drive. Delete the file to force every object to be checked against Google Drive.
+    """
+    create_sql = ('CREATE TABLE IF NOT EXISTS s3_objects (destination TEXT, bucket TEXT, key TEXT, e_tag TEXT, '
+                  'size INTEGER, last_modified TEXT, drive_id TEXT, PRIMARY KEY (destination, bucket, key))')
+
+    def get_objects(self, destination, bucket, prefix):
+        """ :return: dictionary of key: (e_tag, size, last_modified, drive_id) """
+        rows = self.fetch('SELECT key, e_tag, size, last_modified, drive_id FROM s3_objects '
+                          'WHERE destination = ? AND bucket = ? AND substr(key, 1, ?) = ?',
+                          (destination, bucket, len(prefix), prefix))
+        return {r[0]: r[1:] for r in rows}
+
+    def set(self, destination, bucket, key, e_tag, size, last_modified, drive_id):
+        self.write('INSERT OR REPLACE INTO s3_objects VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (destination, bucket, key, e_tag, size, str(last_modified), drive_id))
+
+    def delete(self, destination, bucket, key):
+        self.write('DELETE FROM s3_objects WHERE destination = ? AND bucket = ? AND key = ?',
+                   (destination, bucket, key))
+
+
+class IncrementalBases(SqliteStore):
+    """ Table change signatures at the time of the full backup each differential backup is based on """
+    create_sql = ('CREATE TABLE IF NOT EXISTS bases (destination TEXT PRIMARY KEY, file_id TEXT, created REAL, '
+                  'signatures TEXT)')
+
+    def get(self, destination):
+        rows = self.fetch('SELECT file_id, created, signatures FROM bases WHERE destination = ?', (destination,))
+        if rows:
+            return {'file_id': rows[0][0], 'created': rows[0][1], 'signatures': json.loads(rows[0][2])}
+
+    def set(self, destination, file_id, signatures):
+        self.write('INSERT OR REPLACE INTO bases VALUES (?, ?, ?, ?)',
+                   (destination, file_id, time.time(), json.dumps(signatures)))
+
+
+class ChunkReferences(SqliteStore):
+    """ Chunk ids listed in each chunk store manifest. Manifests are never modified so are only downloaded once """
+    create_sql = 'CREATE TABLE IF NOT EXISTS chunk_refs (manifest_id TEXT PRIMARY KEY, chunk_ids TEXT)'
+
+    def get_all(self):
+        """ :return: dictionary of manifest id: list of chunk ids """
+        return {r[0]: json.loads(r[1]) for r in self.fetch('SELECT manifest_id, chunk_ids FROM chunk_refs', ())}
+
+    def set(self, manifest_id, chunk_ids):
+        self.write('INSERT OR REPLACE INTO chunk_refs VALUES (?, ?)', (manifest_id, json.dumps(chunk_ids)))
+
+    def delete(self, manifest_id):
+        self.write('DELETE FROM chunk_refs WHERE manifest_id = ?', (manifest_id,))
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField(db_index=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('ok', 'OK'), ('failed', 'Failed')], default='running', max_length=10)),
+                ('host', models.CharField(blank=True, max_length=100)),
+                ('schema', models.CharField(blank=True, max_length=63)),
+                ('table', models.CharField(blank=True, max_length=63)),
+                ('all_schemas', models.BooleanField(default=False)),
+                ('seconds', models.FloatField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ('-started',),
+            },
+        ),
+        migrations.CreateModel(
+            name='BackupStage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=40)),
+                ('target', models.CharField(blank=True, max_length=200)),
+                ('seconds', models.FloatField()),
+                ('bytes', models.BigIntegerField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('ok', 'OK'), ('failed', 'Failed')], default='ok', max_length=10)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stages', to='gdrive_backup.backuprun')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+    ]
@@ -8,6 +8,8 @@ from django_modals.task_modals import TaskModal
 from ajax_helpers.utils import is_ajax
 
 from gdrive_backup.backup import Backup
+from .catalog import invalidate_catalog
+from .drive_cache import invalidate
 
 
 class SuperUserMixin(UserPassesTestMixin):
@@ -67,6 +69,7 @@ class ConfirmEmptyTrashModal(SuperUserMixin, Modal):
     def button_empty_trash(self, **_kwargs):
         db = Backup().get_backup_db()
         db.drive.service.files().emptyTrash().execute()
+        invalidate()
         return self.command_response('reload')
 
     def get_modal_buttons(self):
@@ -87,6 +90,7 @@ class ConfirmDropSchemaModal(SuperUserMixin, Modal):
         with connection.cursor() as cursor:
             cursor.execute("DROP SCHEMA public CASCADE")
             cursor.execute("CREATE SCHEMA public")
+        invalidate_catalog()
         return self.command_response('close')
 
     def get_modal_buttons(self):
@@ -0,0 +1,52 @@
+from django.db import models
+
+
+class BackupRun(models.Model):
+    """ A call of Backup.backup_db_and_folders """
+    STATUS_CHOICES = (('running', 'Running'), ('ok', 'OK'), ('failed', 'Failed'))
+
+    started = models.DateTimeField(db_index=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='running')
+    host = models.CharField(max_length=100, blank=True)
+    schema = models.CharField(max_length=63, blank=True)
+    table = models.CharField(max_length=63, blank=True)
+    all_schemas = models.BooleanField(default=False)
+    seconds = models.FloatField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ('-started',)
+
+    def __str__(self):
+        return f'{self.started:%Y-%m-%d %H:%M} {self.status}'
+
+    def stage_total(self, name, field='bytes'):
+        return sum(getattr(s, field) or 0 for s in self.stages.all() if s.name == name)
+
+    @property
+    def compression_ratio(self):
+        """ Bytes dumped for each byte uploaded """
+        uploaded = self.stage_total('upload')
+        return self.stage_total('dump') / uploaded if uploaded else None
+
+
+class BackupStage(models.Model):
+    """
+    Time and bytes of one stage of a run. Database backup stages are dump, compress, upload and check_upload with the
+    backup name as the target, the others are prune, collect_garbage, folders and s3 with the folder as the target.
+    """
+    STATUS_CHOICES = (('ok', 'OK'), ('failed', 'Failed'))
+
+    run = models.ForeignKey(BackupRun, on_delete=models.CASCADE, related_name='stages')
+    name = models.CharField(max_length=40)
+    target = models.CharField(max_length=200, blank=True)
+    seconds = models.FloatField()
+    bytes = models.BigIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='ok')
+
+    class Meta:
+        ordering = ('id',)
+
+    def __str__(self):
+        return f'{self.name} {self.target}'
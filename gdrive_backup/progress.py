@@ -0,0 +1,137 @@
+import io
+import threading
+import time
+
+from .catalog import size_pretty
+
+
+class CountingStream(io.RawIOBase):
+    """ Passes reads through to a stream calling counter with the number of bytes read """
+
+    def __init__(self, stream, counter):
+        self.stream = stream
+        self.counter = counter
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.stream.seekable()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.stream.seek(offset, whence)
+
+    def tell(self):
+        return self.stream.tell()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data:
+            self.counter(len(data))
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class Progress:
+    """
+    Bytes through each stage of a backup with the time spent in each. Stages can run at the same time when the dump
+    is streamed through the compressor into the upload. The metrics are passed to the progress method of the logger,
+    if it has one, no more than once every interval seconds so the celery result backend is not updated for every
+    chunk.
+    """
+
+    def __init__(self, logger, name=None, interval=2.0):
+        self.logger = logger
+        self.name = name
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.started = time.time()
+        self.last_report = 0
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = {'bytes': 0, 'total': None, 'start': time.time(), 'end': None}
+        return self.stages[stage]
+
+    def start(self, stage, total=None):
+        """ :param total: expected bytes used for the estimated time remaining """
+        with self.lock:
+            s = self._stage(stage)
+            if total is not None:
+                s['total'] = total
+
+    def count(self, stage, size):
+        with self.lock:
+            self._stage(stage)['bytes'] += size
+        self.report()
+
+    def set(self, stage, size):
+        """ Sets the bytes of a stage to a total, such as the offset acknowledged by a resumed upload """
+        with self.lock:
+            self._stage(stage)['bytes'] = size
+        self.report()
+
+    def finish(self, stage):
+        with self.lock:
+            if stage in self.stages:
+                self.stages[stage]['end'] = time.time()
+        self.report(force=True)
+
+    def metrics(self):
+        now = time.time()
+        with self.lock:
+            stages = {}
+            for stage, s in self.stages.items():
+                seconds = (s['end'] or now) - s['start']
+                stages[stage] = {'bytes': s['bytes'], 'total': s['total'], 'seconds': round(seconds, 3),
+                                 'rate': s['bytes'] / seconds if seconds > 0 else 0, 'done': s['end'] is not None}
+        active = [k for k, s in stages.items() if not s['done']]
+        phase = active if active else list(stages)[-1:]
+        remaining = [(s['total'] - s['bytes']) / s['rate'] for k, s in stages.items()
+                     if k in active and s['total'] and s['rate'] > 0]
+        return {'name': self.name,
+                'phase': '+'.join(phase),
+                'elapsed': round(now - self.started, 3),
+                'rate': stages[phase[-1]]['rate'] if phase else 0,
+                'eta': max(0, max(remaining)) if remaining else None,
+                'stages': stages}
+
+    def report(self, force=False):
+        report = getattr(self.logger, 'progress', None)
+        if report is None:
+            return
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_report < self.interval:
+                return
+            self.last_report = now
+        report(self.metrics())
+
+
+def rate_pretty(rate):
+    return f'{size_pretty(rate)}/s'
+
+
+def progress_text(metrics):
+    """ Single line of the bytes, rate and estimated time remaining of the current phase """
+    if not metrics['stages']:
+        return ''
+    stage = metrics['stages'][metrics['phase'].split('+')[-1]]
+    text = f'{metrics["phase"]} {size_pretty(stage["bytes"])}'
+    if stage['total']:
+        text += f' of {size_pretty(stage["total"])}'
+    text += f' {rate_pretty(metrics["rate"])}'
+    if metrics['eta'] is not None:
+        text += f' {metrics["eta"]:.0f}s remaining'
+    return text
+
+
+def summary_text(metrics):
+    """ Bytes, time and rate of each stage to show which stage limited the backup """
+    return ', '.join(f'{k} {size_pretty(s["bytes"])} in {s["seconds"]:.1f}s {rate_pretty(s["rate"])}' if s['bytes']
+                     else f'{k} {s["seconds"]:.1f}s' for k, s in metrics['stages'].items())
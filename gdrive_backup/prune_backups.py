@@ -2,39 +2,68 @@ import datetime
 
 
 class PruneBackups:
+    """
+    Selects the backups to keep for a retention recipe. The backups are sorted newest first once and every line of the
+    recipe keeps the newest backup of each of its periods in the same pass, so the cost does not grow with the
+    number of recipe lines times the number of backups.
+    """
 
-    def __init__(self, backup_dict):
-        self.keep = []
+    def __init__(self, backup_dict, now=None):
+        """
+        :param backup_dict: dictionary of created datetime to backup
+        :param now: time the hour and day periods are aligned to, defaults to the current time
+        """
+        self.keep = set()
         self.backup_dict = backup_dict
+        self.now = now if now else datetime.datetime.today()
+
+    def period_key(self, period):
+        start_time = datetime.datetime(2000, 1, 1) + int((self.now - datetime.datetime(2000, 1, 1)) /
+                                                         period) * period + period
+        return lambda b: int((start_time - b) / period)
+
+    @staticmethod
+    def monthly_key(months):
+        return lambda b: -int((b.year * 100 + b.month) / months)
+
+    def tier(self, r):
+        """ Period key function increasing with the age of the backup and the number of periods to keep """
+        if 'months' in r:
+            return self.monthly_key(r['months']), r['number']
+        elif 'days' in r:
+            return self.period_key(datetime.timedelta(days=r['days'])), r['number']
+        elif 'hours' in r:
+            return self.period_key(datetime.timedelta(hours=r['hours'])), r['number']
+
+    def backups_to_keep(self, recipe):
+        tiers = [t for t in (self.tier(r) for r in recipe) if t]
+        last_keys = [None] * len(tiers)
+        # A line always keeps at least the newest backup
+        remaining = [max(t[1], 1) for t in tiers]
+        for b in sorted(self.backup_dict, reverse=True):
+            if not any(remaining):
+                break
+            for i, (key, _number) in enumerate(tiers):
+                if remaining[i]:
+                    k = key(b)
+                    # The first backup seen in each period is the newest
+                    if k != last_keys[i]:
+                        last_keys[i] = k
+                        remaining[i] -= 1
+                        self.keep.add(b)
+        return self.keep
 
     def backups_to_remove(self, recipe):
-        for r in recipe:
-            if 'months' in r:
-                self.keep_monthly_backups(r['months'], r['number'])
-            elif 'days' in r:
-                self.keep_backups(datetime.timedelta(days=r['days']), r['number'])
-            elif 'hours' in r:
-                self.keep_backups(datetime.timedelta(hours=r['hours']), r['number'])
+        self.backups_to_keep(recipe)
         return {k: v for k, v in self.backup_dict.items() if k not in self.keep}
 
-    def keep_backups(self, period, number):
-        period_dict = {}
-        start_time = datetime.datetime(2000, 1, 1) + int((datetime.datetime.today() -
-                                                          datetime.datetime(2000, 1, 1)) / period) * period + period
-        for b in self.backup_dict:
-            period_dict.setdefault(int((start_time - b) / period), []).append(b)
-        for k in sorted(period_dict.keys()):
-            self.keep.append(max(period_dict[k]))
-            number -= 1
-            if number < 1:
-                break
 
-    def keep_monthly_backups(self, period, number):
-        period_dict = {}
-        for b in self.backup_dict:
-            period_dict.setdefault(int(int(b.strftime('%Y%m')) / period), []).append(b)
-        for k in sorted(period_dict.keys(), reverse=True):
-            self.keep.append(max(period_dict[k]))
-            number -= 1
-            if number < 1:
-                break
+def select_removals(backups, recipe, now=None):
+    """
+    :param backups: Google Drive backup files in a single folder with createdTime datetimes
+    :return: list of the backups to remove, keeping the base of any differential backup that is kept
+    """
+    backup_dict = {b['createdTime']: b for b in backups}
+    removal = PruneBackups(backup_dict, now).backups_to_remove(recipe)
+    bases = {b.get('appProperties', {}).get('base') for k, b in backup_dict.items() if k not in removal}
+    return [b for b in removal.values() if b['id'] not in bases]
@@ -0,0 +1,30 @@
+import random
+import time
+
+from googleapiclient.http import HttpError
+
+rate_limit_reasons = [b'rateLimitExceeded', b'userRateLimitExceeded']
+
+
+def is_rate_limited(error):
+    if error.resp.status == 429:
+        return True
+    if error.resp.status == 403:
+        return any(r in (error.content or b'') for r in rate_limit_reasons)
+    return False
+
+
+def call_with_backoff(function, *args, retries=8, max_wait=64, **kwargs):
+    """
+    Calls function retrying with exponential backoff and jitter when Google Drive responds with a 403 or 429 rate
+    limit error. Other errors are raised immediately.
+    """
+    attempt = 0
+    while True:
+        try:
+            return function(*args, **kwargs)
+        except HttpError as e:
+            if attempt >= retries or not is_rate_limited(e):
+                raise
+            time.sleep(min(max_wait, 2 ** attempt) + random.random())
+            attempt += 1
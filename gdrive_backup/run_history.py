@@ -0,0 +1,131 @@
+import datetime
+import time
+from contextlib import contextmanager
+
+from django.db import DatabaseError
+from django.utils import timezone
+
+from .models import BackupRun, BackupStage
+
+# Database backup stages in the order they run followed by the other stages of a run
+stage_order = ['dump', 'compress', 'upload', 'check_upload', 'prune', 'collect_garbage', 'folders', 's3']
+
+
+class RunHistory:
+    """
+    Records each run of Backup.backup_db_and_folders as a BackupRun with a BackupStage for each stage. Recording never
+    stops a backup, a database error (such as the migrations not being applied) is logged and recording is turned off
+    for the rest of the run.
+    """
+
+    def __init__(self, logger, enabled=True, keep_days=365):
+        """ :param keep_days: runs older than this are deleted at the end of each run """
+        self.logger = logger
+        self.enabled = enabled
+        self.keep_days = keep_days
+        self.run = None
+
+    def save(self, function):
+        if not self.enabled:
+            return None
+        try:
+            return function()
+        except DatabaseError as e:
+            self.logger.info(f'Backup run history not recorded {e!r}')
+            self.enabled = False
+
+    @contextmanager
+    def record(self, host='', schema=None, table=None, all_schemas=False):
+        start = time.time()
+        self.run = self.save(lambda: BackupRun.objects.create(started=timezone.now(), host=host, schema=schema or '',
+                                                              table=table or '', all_schemas=all_schemas))
+        status, error = 'failed', ''
+        try:
+            yield self
+            status = 'ok'
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            if self.run:
+                self.run.status = status
+                self.run.error = error
+                self.run.finished = timezone.now()
+                self.run.seconds = time.time() - start
+                self.save(self.run.save)
+                self.save(self.delete_old_runs)
+            self.run = None
+
+    @contextmanager
+    def stage(self, name, target=''):
+        start = time.time()
+        status = 'failed'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            self.add_stage(name, target, time.time() - start, status=status)
+
+    def add_stage(self, name, target, seconds, size=None, status='ok'):
+        if self.run:
+            self.save(lambda: BackupStage.objects.create(run=self.run, name=name, target=target, seconds=seconds,
+                                                         bytes=size, status=status))
+
+    def add_metrics(self, metrics):
+        """ Stages of database backups from the Progress metrics of each backup, unfinished stages failed """
+        for m in metrics:
+            for name, s in m['stages'].items():
+                self.add_stage(name, m['name'] or '', s['seconds'], s['bytes'], 'ok' if s['done'] else 'failed')
+
+    def delete_old_runs(self):
+        BackupRun.objects.filter(started__lt=timezone.now() - datetime.timedelta(days=self.keep_days)).delete()
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(**kwargs):
+    return '{' + ','.join(f'{k}="{escape_label(v)}"' for k, v in kwargs.items()) + '}'
+
+
+def prometheus_metrics():
+    """
+    Prometheus text format metrics of the latest run of each host, when it finished and how long it took, with the
+    time and bytes of each stage of the latest successful run. Stage times can be compared with the backup window and
+    their history in a Prometheus server shows how they grow with the database.
+    """
+    metrics = {
+        'gdrive_backup_last_run_timestamp_seconds': ('gauge', 'Finish time of the latest backup run', []),
+        'gdrive_backup_last_run_success': ('gauge', '1 if the latest backup run succeeded', []),
+        'gdrive_backup_last_run_seconds': ('gauge', 'Duration of the latest backup run', []),
+        'gdrive_backup_last_success_timestamp_seconds': ('gauge', 'Finish time of the latest successful backup run',
+                                                         []),
+        'gdrive_backup_stage_seconds': ('gauge', 'Seconds spent in each stage of the latest successful backup run',
+                                        []),
+        'gdrive_backup_stage_bytes': ('gauge', 'Bytes through each stage of the latest successful backup run', []),
+    }
+    finished = BackupRun.objects.exclude(status='running')
+    for host in finished.order_by().values_list('host', flat=True).distinct():
+        runs = finished.filter(host=host)
+        run = runs.first()
+        if run is None:
+            continue
+        host_labels = labels(host=host)
+        metrics['gdrive_backup_last_run_timestamp_seconds'][2].append((host_labels, run.finished.timestamp()))
+        metrics['gdrive_backup_last_run_success'][2].append((host_labels, int(run.status == 'ok')))
+        metrics['gdrive_backup_last_run_seconds'][2].append((host_labels, run.seconds))
+        success = runs.filter(status='ok').first()
+        if success is None:
+            continue
+        metrics['gdrive_backup_last_success_timestamp_seconds'][2].append((host_labels, success.finished.timestamp()))
+        for s in success.stages.all():
+            stage_labels = labels(host=host, stage=s.name, target=s.target)
+            metrics['gdrive_backup_stage_seconds'][2].append((stage_labels, s.seconds))
+            if s.bytes is not None:
+                metrics['gdrive_backup_stage_bytes'][2].append((stage_labels, s.bytes))
+    lines = []
+    for name, (metric_type, description, samples) in metrics.items():
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}']
+        lines += [f'{name}{sample_labels} {value}' for sample_labels, value in samples]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,161 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+from google_client.drive import folder_type
+
+from .drive_pool import get_drive, find_create_folder
+from .rate_limit import call_with_backoff
+
+
+class SchemaBackupError(Exception):
+    pass
+
+
+class Slots:
+    """ Semaphore whose permits are taken several at once, all or none so that partial holders cannot deadlock """
+
+    def __init__(self, size):
+        self.size = size
+        self.free = size
+        self.condition = threading.Condition()
+
+    def acquire(self, count=1):
+        with self.condition:
+            self.condition.wait_for(lambda: self.free >= count)
+            self.free -= count
+
+    def release(self, count=1):
+        with self.condition:
+            self.free += count
+            self.condition.notify_all()
+
+
+class StageLimits:
+    """
+    Limits how many backups are in each stage at once. dump takes a slot for each database connection the dump opens,
+    compress uses CPU and upload a Google Drive upload slot. A backup needing several stages at once must acquire them
+    in the order dump, compress, upload so backups cannot deadlock.
+    """
+
+    def __init__(self, db_connections=2, compression=2, uploads=4):
+        self.slots = {'dump': Slots(db_connections), 'compress': Slots(compression), 'upload': Slots(uploads)}
+
+    def acquire(self, stage, count=1):
+        """
+        A count above the limit takes every slot so the stage runs alone rather than waiting forever
+        :return: slots taken, to be released
+        """
+        count = min(count, self.slots[stage].size)
+        self.slots[stage].acquire(count)
+        return count
+
+    def release(self, stage, count=1):
+        self.slots[stage].release(count)
+
+
+class SchemaFolders:
+    """ Google Drive folder for each schema below the database backup folder listed once and shared by all schemas """
+
+    def __init__(self, drive, db_folder_path):
+        self.drive = drive
+        self.lock = threading.Lock()
+        self.root = find_create_folder(drive, db_folder_path, shared_with_me=True)
+        self.folders = {f['name']: f for f in call_with_backoff(
+            drive.file_list, q=drive.build_q(folder=self.root['id'], mime_type=folder_type))}
+
+    def folder(self, name):
+        with self.lock:
+            if name not in self.folders:
+                folder = call_with_backoff(self.drive.create_folder, name, self.root)
+                self.folders[name] = dict(folder, name=name)
+            return self.folders[name]
+
+
+class SchemaBackups:
+    """
+    Backs up many schemas concurrently. Each of workers threads takes a schema through dump, compression and upload
+    limited by the shared StageLimits. Each thread has its own Google Drive client as they are not thread safe.
+    """
+
+    def __init__(self, backup, google_credentials, db_folder_path, workers=4, limits=None):
+        """
+        :param backup: Backup used to create the BackupDb for each schema
+        """
+        self.backup = backup
+        self.google_credentials = google_credentials
+        self.workers = workers
+        self.limits = limits if limits else StageLimits()
+        self.lock = threading.Lock()
+        self.sizes = None
+        self.completed = 0
+        self.completed_size = 0
+        self.results = []
+        self.folders = SchemaFolders(self.drive, db_folder_path)
+
+    @property
+    def drive(self):
+        return get_drive(self.google_credentials)
+
+    def backup_schema(self, schema, table, sub_folder, snapshot, signatures):
+        start = time.time()
+        result = {'schema': schema, 'status': 'ok', 'error': None, 'stages': {}, 'metrics': None}
+        db = None
+        try:
+            db = self.backup.get_backup_db(schema, table, drive=self.drive, limits=self.limits, snapshot=snapshot,
+                                           snapshot_signatures=signatures,
+                                           folder=self.folders.folder(sub_folder if sub_folder else schema))
+            db.backup_db_gdrive()
+            result['stages'] = db.stage_times
+        except Exception as e:
+            self.backup.logger.info(f'Backup of schema {schema} failed {e!r}')
+            result.update(status='failed', error=repr(e))
+        finally:
+            # Django opens a connection for each worker thread
+            connection.close()
+        result['metrics'] = db.metrics if db else None
+        result['seconds'] = time.time() - start
+        self.progress(schema)
+        return result
+
+    def progress(self, schema):
+        if not self.sizes:
+            return
+        with self.lock:
+            self.completed += 1
+            self.completed_size += self.sizes.get(schema, 0)
+            self.backup.logger.info(f'{self.completed} of {len(self.sizes)} schemas done, '
+                                    f'{100 * self.completed_size / (sum(self.sizes.values()) or 1):.0f}% of the '
+                                    f'database size')
+
+    def run(self, schemas, table=None, sub_folder=None, snapshot=None, sizes=None, signatures=None):
+        """
+        Schemas are started in the order given, largest first keeps the slowest from starting last
+        :param snapshot: Exported snapshot id every schema is dumped from
+        :param signatures: table signatures of every schema read before snapshot was exported
+        :param sizes: dictionary of schema to its size to log progress as schemas complete
+        :return: list of result dictionaries for each schema with status, error, seconds, stage timings and metrics
+        """
+        start = time.time()
+        self.sizes = {s: sizes.get(s, 0) for s in schemas} if sizes else None
+        self.completed = self.completed_size = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(lambda s: self.backup_schema(s, table, sub_folder, snapshot, signatures),
+                                        schemas))
+        self.results = results
+        self.report(results, time.time() - start)
+        failed = [r['schema'] for r in results if r['status'] != 'ok']
+        if failed:
+            raise SchemaBackupError(f'{len(failed)} of {len(results)} schemas failed: {", ".join(failed)}')
+        return results
+
+    def report(self, results, elapsed):
+        for r in results:
+            stage_times = ' '.join(f'{k} {v:.1f}s' for k, v in r['stages'].items())
+            self.backup.logger.info(f'{r["schema"]}: {r["status"]} in {r["seconds"]:.1f}s {stage_times}'
+                                    f'{" " + r["error"] if r["error"] else ""}')
+        total = sum(r['seconds'] for r in results)
+        failed = len([r for r in results if r['status'] != 'ok'])
+        self.backup.logger.info(f'{len(results)} schemas backed up, {failed} failed in {elapsed:.1f}s '
+                                f'({total:.1f}s total backup time)')
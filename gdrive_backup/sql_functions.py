@@ -1,46 +1,122 @@
-from django.db import connection
+from contextlib import contextmanager
 
+from django.db import connection, transaction
 
-def get_schemas():
-    with connection.cursor() as cursor:
-        # cursor.execute('SELECT schema.schema_name, Count(tables.table_name)'
-        #                'FROM information_schema.schemata as schema '
-        #        'Left Join information_schema.tables as tables on tables.table_schema = schema.schema_name '
-        #                    'GROUP BY schema.schema_name')
-
-        cursor.execute(
-            'SELECT pg_catalog.pg_namespace.nspname, pg_size_pretty(SUM(pg_relation_size(pg_catalog.pg_class.oid))) '
-            'FROM pg_catalog.pg_class '
-            'LEFT JOIN pg_catalog.pg_namespace ON relnamespace = pg_catalog.pg_namespace.oid '
-            'GROUP BY pg_catalog.pg_namespace.nspname'
-        )
-        return [schema for schema in cursor.fetchall() if not schema[0].startswith('pg_')
-                and schema[0] not in ['information_schema']]
 
-
-def get_schema_tables(schema):
+def get_relation_sizes():
+    """
+    Total size including indexes and toast and the estimated rows of every table in every schema in one query.
+    Schemas without tables are returned with a None table.
+    :return: list of (schema, table, size, rows)
+    """
     with connection.cursor() as cursor:
         cursor.execute(
-            f" SELECT relname , pg_relation_size(relfilenode), reltuples FROM pg_catalog.pg_class "
-            f"LEFT JOIN pg_catalog.pg_namespace ON relnamespace = pg_catalog.pg_namespace.oid "
-            f"WHERE pg_catalog.pg_namespace.nspname = 'public' AND relkind='r' "
+            'SELECT n.nspname, c.relname, pg_total_relation_size(c.oid), c.reltuples '
+            'FROM pg_catalog.pg_namespace n '
+            "LEFT JOIN pg_catalog.pg_class c ON c.relnamespace = n.oid AND c.relkind IN ('r', 'm') "
+            "WHERE n.nspname NOT LIKE 'pg\\_%' AND n.nspname <> 'information_schema'"
         )
         return cursor.fetchall()
 
 
-def get_table_column_names(schema, table_name):
+def get_table_column_names(schema, table_name, generated=True):
+    """ :param generated: include generated columns, which COPY FROM cannot load """
     with connection.cursor() as cursor:
-        cursor.execute(f"SELECT column_name from INFORMATION_SCHEMA.COLUMNS WHERE "
-                       f"table_name='{table_name}' and table_schema='{schema}'")
+        cursor.execute('SELECT column_name from INFORMATION_SCHEMA.COLUMNS WHERE '
+                       'table_name = %s and table_schema = %s' + ('' if generated else " and is_generated = 'NEVER'") +
+                       ' ORDER BY ordinal_position', [table_name, schema])
         return [c[0] for c in cursor.fetchall()]
 
 
-def get_table_data(schema, table_name):
-    with connection.cursor() as cursor:
-        cursor.execute(f'SELECT * from {schema}."{table_name}"')
-        return cursor.fetchall()
+def table_rows(schema, table_name, batch_size=2000):
+    """
+    Yields lists of up to batch_size rows read with a server side cursor so the table is never held in memory.
+    The transaction keeps the cursor from being materialised on the server as a WITH HOLD cursor would be.
+    """
+    with transaction.atomic(), connection.chunked_cursor() as cursor:
+        cursor.execute(f'SELECT * FROM {quote_name(schema)}.{quote_name(table_name)}')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
 
 
 def delete_table(schema, table_name):
     with connection.cursor() as cursor:
         cursor.execute(f'DELETE from {schema}.{table_name}')
+
+
+def quote_name(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+@contextmanager
+def qualified_cursor():
+    """
+    Cursor with an empty search path so the definitions of objects name them with their schema. The search path is
+    put back afterwards in case the block runs within a transaction.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT current_setting('search_path'), set_config('search_path', 'pg_catalog', true)")
+        search_path = cursor.fetchone()[0]
+        yield cursor
+        cursor.execute("SELECT set_config('search_path', %s, true)", [search_path])
+
+
+def get_table_indexes(schema, table_name):
+    """
+    Indexes of a table that can be dropped and recreated, those enforcing a constraint are left in place
+    :return: list of (index name, CREATE INDEX statement)
+    """
+    with qualified_cursor() as cursor:
+        cursor.execute('SELECT c.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i '
+                       'JOIN pg_class c ON c.oid = i.indexrelid '
+                       'WHERE i.indrelid = %s::regclass AND '
+                       'NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = i.indexrelid)',
+                       [f'{quote_name(schema)}.{quote_name(table_name)}'])
+        return cursor.fetchall()
+
+
+def get_referencing_keys(schema, table_name):
+    """
+    Foreign keys of other tables referring to the table, which stop it being truncated
+    :return: list of (quoted table name, constraint name, constraint definition)
+    """
+    with qualified_cursor() as cursor:
+        cursor.execute('SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint '
+                       'WHERE contype = %s AND confrelid = %s::regclass AND conrelid <> confrelid',
+                       ['f', f'{quote_name(schema)}.{quote_name(table_name)}'])
+        return cursor.fetchall()
+
+
+def get_table_signatures(schema=None):
+    """
+    Change counters of each table. The relfilenode changes on TRUNCATE which is not counted in n_tup_del.
+    :return: dictionary of quoted schema.table: signature
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT schemaname, relname, n_tup_ins, n_tup_upd, n_tup_del, pg_relation_filenode(relid) '
+                       'FROM pg_stat_user_tables' + (' WHERE schemaname = %s' if schema else ''),
+                       [schema] if schema else [])
+        return {f'{quote_name(r[0])}.{quote_name(r[1])}': ':'.join(str(c) for c in r[2:]) for r in cursor.fetchall()}
+
+
+def get_stats_reset():
+    """ Time the statistics counters of the database were last reset, after which table signatures do not compare """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT stats_reset FROM pg_stat_database WHERE datname = current_database()')
+        row = cursor.fetchone()
+        return str(row[0]) if row and row[0] else None
+
+
+@contextmanager
+def exported_snapshot():
+    """
+    Holds a repeatable read transaction open for the duration of the block and yields its exported snapshot id
+    which pg_dump --snapshot can use to see the same state of the database
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+        cursor.execute('SELECT pg_export_snapshot()')
+        yield cursor.fetchone()[0]
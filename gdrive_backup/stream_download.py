@@ -0,0 +1,113 @@
+import hashlib
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from google.auth.transport.requests import AuthorizedSession
+
+from .stream_upload import DEFAULT_CHUNK_SIZE
+
+DOWNLOAD_URL = 'https://www.googleapis.com/drive/v3/files/'
+
+
+class DownloadError(Exception):
+    pass
+
+
+def get_media(session, file_id, start=None, end=None, retries=6):
+    """
+    Downloads the contents of a file or the inclusive byte range start to end retrying rate limit and server errors
+    :param session: AuthorizedSession
+    """
+    headers = {'Range': f'bytes={start}-{end}'} if start is not None else {}
+    attempt = 0
+    while True:
+        try:
+            response = session.get(DOWNLOAD_URL + file_id, params={'alt': 'media', 'supportsAllDrives': 'true'},
+                                   headers=headers)
+            status = response.status_code
+        except requests.exceptions.ConnectionError:
+            status = None
+        if status == 206 or (status == 200 and start is None):
+            return response.content
+        if status == 200:
+            # A server ignoring the range returns the whole file
+            return response.content[start:end + 1]
+        if status is not None and status not in (429, 500, 502, 503, 504):
+            raise DownloadError(f'Download failed {status} {response.text}')
+        attempt += 1
+        if attempt > retries:
+            raise DownloadError(f'Download failed after {retries} retries')
+        time.sleep(2 ** attempt)
+
+
+class DriveDownloadStream(io.RawIOBase):
+    """
+    Readable stream of a Google Drive file downloaded in ranges of chunk_size. read_ahead ranges are fetched on a
+    background thread ahead of the reader so the download overlaps with whatever is consuming the stream.
+    The md5 is checked against the Google Drive md5Checksum at the end of the stream.
+    """
+
+    def __init__(self, drive, google_file, chunk_size=DEFAULT_CHUNK_SIZE, read_ahead=2, retries=6):
+        """
+        :param google_file: dictionary with id, size and md5Checksum as returned by GoogleDrive.get_file
+        """
+        self.session = AuthorizedSession(drive.credentials)
+        self.file_id = google_file['id']
+        self.size = int(google_file.get('size', 0))
+        self.expected_md5 = google_file.get('md5Checksum')
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+        self.retries = retries
+        self.position = 0
+        self.md5 = hashlib.md5()
+        self.ranges = {}
+        # A single thread as the session is not thread safe
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def readable(self):
+        return True
+
+    def get_range(self, index):
+        start = index * self.chunk_size
+        return get_media(self.session, self.file_id, start, min(start + self.chunk_size, self.size) - 1, self.retries)
+
+    def range_data(self, index):
+        last = (self.size - 1) // self.chunk_size
+        self.ranges.pop(index - 1, None)
+        for i in range(index, min(index + self.read_ahead, last) + 1):
+            if i not in self.ranges:
+                self.ranges[i] = self.executor.submit(self.get_range, i)
+        return self.ranges[index].result()
+
+    def read(self, size=-1):
+        if self.position >= self.size:
+            return b''
+        if size < 0 or self.position + size > self.size:
+            size = self.size - self.position
+        output = bytearray()
+        while len(output) < size:
+            index = self.position // self.chunk_size
+            offset = self.position - index * self.chunk_size
+            data = self.range_data(index)[offset:offset + size - len(output)]
+            if not data:
+                raise DownloadError(f'Download of {self.file_id} ended at {self.position} of {self.size} bytes')
+            output += data
+            self.position += len(data)
+        self.md5.update(output)
+        if self.position >= self.size and self.expected_md5 and self.md5.hexdigest() != self.expected_md5:
+            raise DownloadError(f'Downloaded md5 {self.md5.hexdigest()} does not match {self.expected_md5}')
+        return bytes(output)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        for f in self.ranges.values():
+            f.cancel()
+        self.ranges = {}
+        self.executor.shutdown(wait=False)
+        super().close()
@@ -0,0 +1,166 @@
+import hashlib
+import time
+
+import requests
+from google.auth.transport.requests import AuthorizedSession
+
+from .drive_pool import forget_folder
+
+UPLOAD_URL = 'https://www.googleapis.com/upload/drive/v3/files'
+CHUNK_MULTIPLE = 256 * 1024
+DEFAULT_CHUNK_SIZE = 40 * CHUNK_MULTIPLE
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadSessionExpired(UploadError):
+    pass
+
+
+def read_full(stream, size):
+    """ Reads until size bytes or the end of the stream as pipes can return short reads """
+    data = b''
+    while len(data) < size:
+        block = stream.read(size - len(data))
+        if not block:
+            break
+        data += block
+    return data
+
+
+class StreamUpload:
+    """
+    Resumable chunked upload to Google Drive from a forward only stream such as a pipe.
+    Only the current chunk is held in memory. The md5 and size are calculated as the data is sent so the upload can
+    be checked without a local copy of the file.
+    """
+
+    def __init__(self, drive, chunk_size=DEFAULT_CHUNK_SIZE, retries=6, checkpoint=None, progress=None):
+        """
+        :param checkpoint: called with the session uri and acknowledged offset when the upload starts and after each
+        chunk so an interrupted upload can be resumed
+        :param progress: called with the number of bytes acknowledged after each chunk and when resuming
+        """
+        if chunk_size % CHUNK_MULTIPLE:
+            raise ValueError(f'chunk_size must be a multiple of {CHUNK_MULTIPLE}')
+        self.session = AuthorizedSession(drive.credentials)
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.session_uri = None
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def start(self, body):
+        response = self.session.post(UPLOAD_URL, params={'uploadType': 'resumable', 'supportsAllDrives': 'true'},
+                                     json=body, headers={'X-Upload-Content-Type': body['mimeType']})
+        if response.status_code != 200:
+            if response.status_code == 404 and body.get('parents'):
+                forget_folder(body['parents'][0])
+            raise UploadError(f'Could not start upload {response.status_code} {response.text}')
+        self.session_uri = response.headers['Location']
+
+    @staticmethod
+    def parse_range(response):
+        if 'Range' in response.headers:
+            return int(response.headers['Range'].split('-')[-1]) + 1
+        return 0
+
+    def acknowledged(self):
+        """
+        Queries the upload session for the number of bytes stored by Google Drive
+        :return: tuple of offset and google file which is only set if the upload is complete
+        """
+        response = self.session.put(self.session_uri, headers={'Content-Range': 'bytes */*'})
+        if response.status_code in (200, 201):
+            return None, response.json()
+        if response.status_code == 308:
+            return self.parse_range(response), None
+        if response.status_code in (404, 410):
+            raise UploadSessionExpired(f'Upload session expired {response.status_code}')
+        raise UploadError(f'Upload session failed {response.status_code} {response.text}')
+
+    def send_chunk(self, offset, chunk, last):
+        """
+        Sends chunk starting at offset resending any part not acknowledged by the server.
+        :return: google file if last is True
+        """
+        end = offset + len(chunk)
+        total = str(end) if last else '*'
+        attempt = 0
+        while True:
+            if offset < end:
+                content_range = f'bytes {offset}-{end - 1}/{total}'
+            else:
+                content_range = f'bytes */{total}'
+            try:
+                response = self.session.put(self.session_uri, data=chunk[offset + len(chunk) - end:],
+                                            headers={'Content-Range': content_range})
+                status = response.status_code
+            except requests.exceptions.ConnectionError:
+                response = None
+                status = None
+            if status in (200, 201):
+                return response.json()
+            if status == 308:
+                offset = self.parse_range(response)
+                if offset >= end and not last:
+                    return
+                continue
+            if status is not None and status not in (429, 500, 502, 503, 504):
+                raise UploadError(f'Upload failed {status} {response.text}')
+            attempt += 1
+            if attempt > self.retries:
+                raise UploadError(f'Upload failed after {self.retries} retries')
+            time.sleep(2 ** attempt)
+            offset, google_file = self.acknowledged()
+            if google_file:
+                return google_file
+
+    def upload(self, title, parent, data_stream, body=None, mime_type=None):
+        if body is None:
+            body = {}
+        body['name'] = title
+        body['mimeType'] = mime_type if mime_type else 'application/octet-stream'
+        if parent:
+            body['parents'] = [parent['id']]
+        self.start(body)
+        self.save_checkpoint()
+        return self.send_stream(data_stream)
+
+    def resume(self, session_uri, data_stream):
+        """
+        Continues an interrupted upload of a seekable stream from the last byte acknowledged by Google Drive.
+        md5 then only covers the data sent after resuming.
+        """
+        self.session_uri = session_uri
+        offset, google_file = self.acknowledged()
+        if google_file:
+            return google_file
+        data_stream.seek(offset)
+        self.size = offset
+        if self.progress:
+            self.progress(offset)
+        return self.send_stream(data_stream)
+
+    def save_checkpoint(self):
+        if self.checkpoint:
+            self.checkpoint(self.session_uri, self.size)
+
+    def send_stream(self, data_stream):
+        chunk = read_full(data_stream, self.chunk_size)
+        while True:
+            # Read one byte ahead so the final chunk can be sent with the total size
+            next_byte = data_stream.read(1)
+            self.md5.update(chunk)
+            google_file = self.send_chunk(self.size, chunk, not next_byte)
+            self.size += len(chunk)
+            if self.progress:
+                self.progress(len(chunk))
+            if google_file:
+                return google_file
+            self.save_checkpoint()
+            chunk = next_byte + read_full(data_stream, self.chunk_size - 1)
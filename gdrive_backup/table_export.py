@@ -0,0 +1,110 @@
+import csv
+import datetime
+import decimal
+import re
+import tempfile
+import uuid
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.http import Http404, StreamingHttpResponse
+from openpyxl import Workbook
+
+from .sql_functions import get_table_column_names, table_rows
+
+# Rows per sheet including the header
+xlsx_max_rows = 1048576
+xlsx_types = (str, int, float, bool, decimal.Decimal, datetime.date, datetime.time, datetime.timedelta)
+xlsx_content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+export_folder = 'gdrive_backup/exports'
+
+
+class Echo:
+    """ File like object returning what is written so csv.writer can produce lines for a generator """
+
+    @staticmethod
+    def write(value):
+        return value
+
+
+def csv_stream(columns, batches):
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns).encode()
+    for rows in batches:
+        yield ''.join(writer.writerow(r) for r in rows).encode()
+
+
+def xlsx_value(value):
+    if value is None or isinstance(value, xlsx_types):
+        if isinstance(value, datetime.datetime) and value.tzinfo:
+            return value.replace(tzinfo=None)
+        return value
+    return str(value)
+
+
+def write_xlsx(columns, batches, output):
+    """
+    Writes rows with openpyxl write only mode which keeps each sheet in a temporary file rather than in memory.
+    A new sheet is started when a sheet is full.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = None
+    sheet_rows = xlsx_max_rows
+    for rows in batches:
+        for r in rows:
+            if sheet_rows >= xlsx_max_rows:
+                sheet = workbook.create_sheet()
+                sheet.append(columns)
+                sheet_rows = 1
+            sheet.append([xlsx_value(c) for c in r])
+            sheet_rows += 1
+    if sheet is None:
+        workbook.create_sheet().append(columns)
+    workbook.save(output)
+
+
+def export_response(schema, table_name, export_format, batch_size=2000):
+    """
+    Download of a table as csv streamed while it is read so memory use does not depend on the size of the table.
+    xlsx cannot be sent until the workbook is complete so is built by export_xlsx in a celery task.
+    """
+    columns = get_table_column_names(schema, table_name)
+    if not columns or export_format != 'csv':
+        raise Http404
+    response = StreamingHttpResponse(csv_stream(columns, table_rows(schema, table_name, batch_size)),
+                                     content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{table_name}.csv"'
+    return response
+
+
+def export_xlsx(schema, table_name, batch_size=2000):
+    """
+    Builds an xlsx of the table in a temporary file and saves it in the default storage, which must be shared by the
+    celery workers and the web server.
+    :return: key and file name to download it with stored_export_response
+    """
+    columns = get_table_column_names(schema, table_name)
+    if not columns:
+        raise ValueError(f'Table {schema}.{table_name} not found')
+    key = uuid.uuid4().hex
+    with tempfile.TemporaryFile() as output:
+        write_xlsx(columns, table_rows(schema, table_name, batch_size), output)
+        output.seek(0)
+        default_storage.save(f'{export_folder}/{key}.xlsx', File(output))
+    return key, f'{table_name}.xlsx'
+
+
+def stored_export_response(key, filename, block_size=64 * 1024):
+    """ Streams an export saved by export_xlsx once, it is removed from the storage when fully sent """
+    name = f'{export_folder}/{key}.xlsx'
+    if not re.fullmatch('[0-9a-f]{32}', key) or not default_storage.exists(name):
+        raise Http404
+
+    def blocks():
+        with default_storage.open(name) as f:
+            yield from iter(lambda: f.read(block_size), b'')
+        default_storage.delete(name)
+
+    response = StreamingHttpResponse(blocks(), content_type=xlsx_content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -1,38 +1,65 @@
 import logging
+import threading
+import time
 
 from celery import shared_task
+from django.conf import settings
 from django.db import connection
+from django.urls import reverse
 
 from .backup import Backup
+from .drive_cache import invalidate
+from .progress import progress_text
+from .table_export import export_xlsx
 
 logger = logging.getLogger(__name__)
 
 
 @shared_task
 def backup():
-    Backup().backup_db_and_folders()
+    backup_run = Backup()
+    backup_run.backup_db_and_folders()
+    return {'metrics': backup_run.metrics}
 
 
 @shared_task
 def backup_all_schemas():
-    Backup().backup_db_and_folders(all_schemas=True)
+    backup_run = Backup()
+    backup_run.backup_db_and_folders(all_schemas=True)
+    return {'metrics': backup_run.metrics}
 
 
 @shared_task
 def empty_trash():
     db = Backup().get_backup_db()
     db.drive.service.files().emptyTrash().execute()
+    invalidate()
 
 
 class StateLogger:
 
-    def __init__(self, task):
+    def __init__(self, task, interval=None):
+        """ :param interval: minimum seconds between progress updates shared by concurrent backups """
         self.task = task
+        self.interval = interval if interval is not None else getattr(settings, 'BACKUP_PROGRESS_INTERVAL', 2)
+        self.message = ''
+        self.lock = threading.Lock()
+        self.last_progress = 0
 
     def info(self, text):
         logger.info(text)
+        self.message = text
         self.task.update_state(state='PROGRESS', meta={'message': text})
 
+    def progress(self, metrics):
+        with self.lock:
+            now = time.time()
+            if now - self.last_progress < self.interval:
+                return
+            self.last_progress = now
+        self.task.update_state(state='PROGRESS', meta={'message': f'{self.message} {progress_text(metrics)}',
+                                                       'progress': metrics})
+
 
 try:
     from ajax_helpers.utils import ajax_command
@@ -40,8 +67,10 @@ try:
     @shared_task(bind=True)
     def ajax_backup(self, **kwargs):
         task_kwargs = kwargs['slug'] if 'slug' in kwargs else kwargs
-        Backup(StateLogger(self)).backup_db_and_folders(**task_kwargs)
-        return {'commands': [ajax_command('message', text='Backup Complete'), ajax_command('reload')]}
+        backup_run = Backup(StateLogger(self))
+        backup_run.backup_db_and_folders(**task_kwargs)
+        return {'commands': [ajax_command('message', text='Backup Complete'), ajax_command('reload')],
+                'metrics': backup_run.metrics}
 
     @shared_task(bind=True)
     def ajax_restore(self, *, slug, **_kwargs):
@@ -52,5 +81,12 @@ try:
         Backup(StateLogger(self)).get_backup_db().restore_gdrive_db(file_id=slug['pk'])
         return {'commands': [ajax_command('message', text='Restore Complete'), ajax_command('reload')]}
 
+    @shared_task(bind=True)
+    def ajax_export_table(self, *, slug, **_kwargs):
+        StateLogger(self).info(f'Exporting {slug["table"]}')
+        key, filename = export_xlsx(slug['schema'], slug['table'])
+        return {'commands': [ajax_command('close'), ajax_command(
+            'redirect', url=reverse('gdrive_backup:export_download', args=[key, filename]))]}
+
 except ModuleNotFoundError:
     pass
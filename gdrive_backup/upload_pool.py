@@ -0,0 +1,113 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .base_backup import BaseBackup
+from .drive_pool import get_drive
+from .rate_limit import call_with_backoff
+
+
+class UploadPoolError(Exception):
+    pass
+
+
+class UploadPool:
+    """
+    Hashes files on one thread pool and uploads the changed files on another so many small files are limited by
+    bandwidth rather than the latency of each request. Each upload thread has its own GoogleDrive client as the
+    underlying http connection is not thread safe.
+    """
+
+    def __init__(self, google_credentials, logger, workers=8, hash_workers=4, progress_interval=100):
+        self.google_credentials = google_credentials
+        self.logger = logger
+        self.hash_executor = ThreadPoolExecutor(max_workers=hash_workers)
+        self.upload_executor = ThreadPoolExecutor(max_workers=workers)
+        # Bounds the number of files queued so large trees are not all held in memory
+        self.queued = threading.BoundedSemaphore((workers + hash_workers) * 4)
+        self.lock = threading.Lock()
+        self.progress_interval = progress_interval
+        self.checked = 0
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.failed = []
+
+    @property
+    def drive(self):
+        return get_drive(self.google_credentials)
+
+    def info(self, text):
+        with self.lock:
+            self.logger.info(text)
+
+    def submit(self, filename, google_folder, existing_hashes, display_name=None, md5=None, callback=None):
+        """
+        :param filename: local file which is uploaded using the same name
+        :param google_folder: google drive folder dictionary
+        :param existing_hashes: md5 hashes of the files already in google_folder with the same name. If a dictionary
+        of md5: google file id the id is passed to callback
+        :param display_name: name used in log messages
+        :param md5: if already known the file is not hashed
+        :param callback: called with the md5 and google file id once the file is in google drive
+        """
+        self.queued.acquire()
+        try:
+            self.hash_executor.submit(self.check_file, filename, google_folder, existing_hashes,
+                                      display_name or filename, md5, callback)
+        except Exception:
+            self.queued.release()
+            raise
+
+    def check_file(self, filename, google_folder, existing_hashes, display_name, md5, callback):
+        try:
+            if md5 is None:
+                md5 = BaseBackup.md5sum(filename)
+            if md5 in existing_hashes:
+                self.info('    Exists - ' + display_name)
+                if callback:
+                    callback(md5, existing_hashes[md5] if isinstance(existing_hashes, dict) else None)
+                self.file_done()
+            else:
+                self.upload_executor.submit(self.upload_file, filename, google_folder, display_name, md5, callback)
+        except Exception as e:
+            self.file_failed(filename, e)
+
+    def upload_file(self, filename, google_folder, display_name, md5, callback):
+        try:
+            self.info('Backup - ' + display_name)
+            with open(filename, 'rb') as backup_stream:
+                google_file = call_with_backoff(self.drive.create_file_stream, filename, google_folder,
+                                                backup_stream)
+            if callback:
+                callback(md5, google_file['id'])
+            with self.lock:
+                self.uploaded += 1
+                self.uploaded_bytes += os.path.getsize(filename)
+            self.file_done()
+        except Exception as e:
+            self.file_failed(filename, e)
+
+    def file_failed(self, filename, error):
+        self.info(f'Failed - {filename} {error}')
+        with self.lock:
+            self.failed.append(filename)
+        self.file_done()
+
+    def file_done(self):
+        with self.lock:
+            self.checked += 1
+            report = self.checked % self.progress_interval == 0
+        self.queued.release()
+        if report:
+            self.progress()
+
+    def progress(self):
+        self.info(f'Checked {self.checked} files, uploaded {self.uploaded} '
+                  f'({self.uploaded_bytes / (1024 * 1024):.1f} MB)')
+
+    def join(self):
+        self.hash_executor.shutdown(wait=True)
+        self.upload_executor.shutdown(wait=True)
+        self.progress()
+        if self.failed:
+            raise UploadPoolError(f'{len(self.failed)} files failed to upload')
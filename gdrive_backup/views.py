@@ -1,10 +1,17 @@
+import hmac
+
+from django.conf import settings
 from django.contrib.auth.mixins import PermissionRequiredMixin
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views import View
 from django.views.generic import TemplateView
 from django.shortcuts import redirect
 from encrypted_credentials import django_credentials
-from google_client.drive import GoogleDrive
 from .tasks import backup
 from .backup import Backup
+from .drive_cache import invalidate
+from .drive_pool import get_drive
+from .run_history import prometheus_metrics
 
 
 class BackupInfo(PermissionRequiredMixin, TemplateView):
@@ -14,12 +21,12 @@ class BackupInfo(PermissionRequiredMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         db = Backup().get_backup_db()
-        about = (db.drive.service.about().get(fields='*').execute())
-        meta = db.base_backup_dir
-        meta['space_used'] = int(about['storageQuota']['usage']) / (1024*1024*1024)
-        meta['space_available'] = int(about['storageQuota']['limit']) / (1024*1024*1024)
-        meta['files'] = db.get_db_backup_files()
-        meta['deleted_files'] = db.get_db_backup_files(trashed=True)
+        quota = db.storage_quota()
+        meta = dict(db.base_backup_dir)
+        meta['space_used'] = int(quota['usage']) / (1024*1024*1024)
+        meta['space_available'] = int(quota['limit']) / (1024*1024*1024)
+        meta['files'] = db.cached_db_backup_files()
+        meta['deleted_files'] = db.cached_db_backup_files(trashed=True)
         return meta
 
 
@@ -35,6 +42,23 @@ class EmptyTrashView(PermissionRequiredMixin, TemplateView):
     permission_required = 'access_admin'
 
     def get(self, request, *args, **kwargs):
-        drive = GoogleDrive(django_credentials.get_credentials('drive'))
+        drive = get_drive(django_credentials.get_credentials('drive'))
         drive.service.files().emptyTrash().execute()
+        invalidate()
         return redirect('backup-info')
+
+
+class MetricsView(View):
+    """
+    Backup run metrics in the Prometheus text format. With BACKUP_METRICS_TOKEN set the scraper sends it as a bearer
+    token, otherwise the user needs the access_admin permission.
+    """
+
+    def get(self, request, *args, **kwargs):
+        token = getattr(settings, 'BACKUP_METRICS_TOKEN', None)
+        if token:
+            if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+                return HttpResponseForbidden()
+        elif not request.user.has_perm('access_admin'):
+            return HttpResponseForbidden()
+        return HttpResponse(prometheus_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -13,7 +13,8 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/jonesim/django-gdrive-backup",
     include_package_data=True,
-    packages=['gdrive_backup', 'gdrive_backup.management', 'gdrive_backup.management.commands'],
+    packages=['gdrive_backup', 'gdrive_backup.management', 'gdrive_backup.management.commands',
+              'gdrive_backup.migrations'],
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",